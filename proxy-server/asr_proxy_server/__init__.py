@@ -1,31 +1,105 @@
+import asyncio
 import json
-from typing import Any
+import os
+from typing import Optional
 
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import (
+    JSONResponse, PlainTextResponse, StreamingResponse)
 
+from asr_proxy_server import metrics
+from asr_proxy_server.admission import get_controller
 from asr_proxy_server.asr_endpoint import asr_endpoint
-from asr_proxy_server.engine_base import (
-    SpeechRecognitionDone, SpeechRecognitionError)
+from asr_proxy_server.engine_registry import ENGINES
+from asr_proxy_server.messages import encode_response
+from asr_proxy_server.multiplex import multiplex_endpoint
 
 app = FastAPI()
 
+# set by the supervisor when running several worker processes
+METRICS_DIR = os.environ.get('ASR_METRICS_DIR')
+METRICS_INTERVAL = 1.0
+_metrics_task: Optional[asyncio.Task] = None
+
+
+async def _write_metrics(directory: str) -> None:
+    while True:
+        metrics.write_snapshot(directory)
+        await asyncio.sleep(METRICS_INTERVAL)
+
+
+@app.on_event('startup')
+async def startup() -> None:
+    global _metrics_task
+    await ENGINES.preload()
+    if METRICS_DIR:
+        _metrics_task = asyncio.create_task(_write_metrics(METRICS_DIR))
+
+
+@app.on_event('shutdown')
+async def shutdown() -> None:
+    await ENGINES.shutdown()
+    if _metrics_task is not None:
+        _metrics_task.cancel()
+        metrics.write_snapshot(METRICS_DIR)  # type: ignore
+
+
+@app.get('/metrics')
+async def metrics_endpoint() -> PlainTextResponse:
+    if METRICS_DIR:
+        # the sum over all workers (others are up to METRICS_INTERVAL old)
+        metrics.write_snapshot(METRICS_DIR)
+        text = metrics.render(metrics.read_snapshots(METRICS_DIR))
+    else:
+        text = metrics.render()
+    return PlainTextResponse(text, media_type='text/plain; version=0.0.4')
+
+
+@app.get('/utilization')
+async def utilization_endpoint() -> JSONResponse:
+    """Session slots of each engine in this worker (for load balancers).
+
+    The status is 503 while any engine rejects new sessions.
+    """
+    engines = get_controller().status()
+    accepting = all(e['accepting'] for e in engines.values())
+    return JSONResponse({'accepting': accepting, 'engines': engines},
+                        status_code=200 if accepting else 503)
+
+
+@app.post('/transcribe')
+async def transcribe_endpoint(
+        request: Request, engine: str = 'google-v1', config: str = '{}',
+        name: str = '') -> StreamingResponse:
+    """Transcribe the Ogg Opus / WAV file in the request body (JSON lines).
+    """
+    # imported here so that `python -m asr_proxy_server.transcribe` does not
+    # import the module twice
+    from asr_proxy_server.transcribe import spool_upload, transcribe_upload
+    engine_config = json.loads(config)
+    # the body is read before responding; StreamingResponse receives
+    # from the client concurrently (to detect disconnects)
+    f = await spool_upload(request.stream())
+    return StreamingResponse(
+        transcribe_upload(f, engine, engine_config, name),
+        media_type='application/x-ndjson')
+
 
 @app.websocket('/ws')
 async def websocket_endpoint(ws: WebSocket) -> None:
     await ws.accept()
+    disconnected = False
     try:
         init_msg = await ws.receive_json()
+        if init_msg.get('protocol') == 'multiplex':
+            await multiplex_endpoint(ws)
+            return
         async for resp in asr_endpoint(init_msg, ws.receive_bytes):
-            if isinstance(resp, SpeechRecognitionDone):
-                await ws.send_text(_json_dumps(resp.to_dict()))
-            elif isinstance(resp, SpeechRecognitionError):
-                await ws.send_text(_json_dumps(resp.to_dict()))
-            else:
-                await ws.send_text(_json_dumps([r.to_dict() for r in resp]))
+            msg = encode_response(resp)
+            await ws.send_text(msg)
+            metrics.sent_chars.inc(len(msg))
+    except WebSocketDisconnect:
+        disconnected = True  # the session was aborted
     finally:
-        await ws.close()
-
-
-def _json_dumps(o: Any) -> str:
-    return json.dumps(
-        o, ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+        if not disconnected:
+            await ws.close()
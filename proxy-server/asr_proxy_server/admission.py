@@ -0,0 +1,213 @@
+"""Admission control of recognition sessions per engine.
+
+Each engine may limit the rate of new sessions (token bucket: `rate`
+sessions/sec with bursts of `burst`) and the number of concurrent sessions
+(`max_concurrent`). A session that cannot start right away waits in a FIFO
+queue of at most `max_waiting` sessions for up to `queue_timeout` seconds;
+when the queue is full or the timeout expires the session is rejected with
+a `service-not-allowed` error, before any audio is read.
+
+Limits are per process and read from `ASR_ADMISSION` (JSON object of
+engine name -> limits), e.g.
+
+    {"google-v1": {"rate": 20, "burst": 40, "max_concurrent": 200}}
+
+Engines without limits are always admitted (but counted).
+"""
+import asyncio
+from asyncio import Future
+from collections import deque
+from dataclasses import dataclass
+import json
+import os
+from typing import Any, Deque, Dict, List, Optional
+
+from asr_proxy_server import metrics
+from asr_proxy_server.engine_base import (
+    SpeechRecognitionError, SpeechRecognitionErrorCode)
+
+
+@dataclass
+class AdmissionLimits:
+    rate: float = 0.0  # new sessions per second (0: no limit)
+    burst: float = 1.0  # token bucket size
+    max_concurrent: int = 0  # (0: no limit)
+    max_waiting: int = 0  # sessions waiting to start
+    queue_timeout: float = 1.0  # max wait [s]
+
+    @staticmethod
+    def parse(cfg: Dict[str, Any]) -> 'AdmissionLimits':
+        rate = max(0.0, float(cfg.get('rate', 0)))
+        return AdmissionLimits(
+            rate=rate,
+            burst=max(1.0, float(cfg.get('burst', rate or 1))),
+            max_concurrent=max(0, int(cfg.get('max_concurrent', 0))),
+            max_waiting=max(0, int(cfg.get('max_waiting', 0))),
+            queue_timeout=max(0.0, float(cfg.get('queue_timeout', 1.0))),
+        )
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0: available now)."""
+        if not self.rate:
+            return 0.0
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate:
+            self._tokens -= 1
+
+
+class EngineAdmission(object):
+    def __init__(self, name: str, limits: AdmissionLimits) -> None:
+        self.name = name
+        self.limits = limits
+        self.active = 0
+        self._bucket = TokenBucket(limits.rate, limits.burst)
+        self._waiters: Deque[Future] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _has_slot(self) -> bool:
+        return not self.limits.max_concurrent or \
+            self.active < self.limits.max_concurrent
+
+    def _try_admit(self, loop: asyncio.AbstractEventLoop) -> bool:
+        if not self._has_slot():
+            return False
+        delay = self._bucket.delay(loop.time())
+        if delay > 0:
+            if self._timer is None:
+                self._timer = loop.call_later(delay, self._wake)
+            return False
+        self._bucket.take()
+        self.active += 1
+        return True
+
+    def _wake(self) -> None:
+        self._timer = None
+        loop = asyncio.get_event_loop()
+        while self._waiters:
+            if self._waiters[0].done():  # timed out / cancelled
+                self._waiters.popleft()
+                continue
+            if not self._try_admit(loop):
+                break
+            self._waiters.popleft().set_result(None)
+
+    def _reject(self, reason: str, message: str) -> SpeechRecognitionError:
+        metrics.admission_rejected.inc(1, self.name, reason)
+        return SpeechRecognitionError(
+            SpeechRecognitionErrorCode.ServiceNotAllowed, message)
+
+    async def acquire(self) -> None:
+        """Wait for a session slot or raise SpeechRecognitionError."""
+        loop = asyncio.get_event_loop()
+        if not self._waiters and self._try_admit(loop):
+            return
+        if len(self._waiters) >= self.limits.max_waiting:
+            raise self._reject('queue_full', '{} is busy'.format(self.name))
+        start = loop.time()
+        fut = loop.create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.limits.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._reject('timeout', '{} is busy'.format(self.name))
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release()  # admitted just before being cancelled
+            raise
+        finally:
+            if not fut.done() or fut.cancelled():
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+        metrics.admission_wait.observe(loop.time() - start, self.name)
+
+    def release(self) -> None:
+        self.active -= 1
+        self._wake()
+
+    def utilization(self) -> float:
+        """Ratio of used session slots (0 without a concurrency limit)."""
+        if not self.limits.max_concurrent:
+            return 0.0
+        return self.active / self.limits.max_concurrent
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'max_concurrent': self.limits.max_concurrent,
+            'utilization': self.utilization(),
+            'accepting': self.waiting < self.limits.max_waiting or (
+                self._has_slot() and not self._bucket.delay(
+                    asyncio.get_event_loop().time())),
+        }
+
+
+class AdmissionController(object):
+    def __init__(self, limits: Dict[str, AdmissionLimits]) -> None:
+        self._limits = limits
+        self._engines: Dict[str, EngineAdmission] = {
+            name: EngineAdmission(name, v) for name, v in limits.items()}
+
+    @staticmethod
+    def from_env() -> 'AdmissionController':
+        cfg = json.loads(os.environ.get('ASR_ADMISSION', '{}'))
+        return AdmissionController({
+            name: AdmissionLimits.parse(v) for name, v in cfg.items()})
+
+    def engine(self, name: str) -> EngineAdmission:
+        return self._engines[name]
+
+    async def acquire(self, names: List[str]) -> None:
+        """Acquire a slot of each engine of `names` (all or none).
+
+        `names` must be registered engines; an entry is kept for each.
+        """
+        acquired: List[EngineAdmission] = []
+        try:
+            for name in names:
+                e = self._engines.get(name)
+                if e is None:
+                    e = self._engines[name] = EngineAdmission(
+                        name, AdmissionLimits())
+                await e.acquire()
+                acquired.append(e)
+        except BaseException:
+            for e in acquired:
+                e.release()
+            raise
+
+    def release(self, names: List[str]) -> None:
+        for name in names:
+            self.engine(name).release()
+
+    def status(self) -> Dict[str, Any]:
+        return {name: e.to_dict() for name, e in self._engines.items()}
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def get_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController.from_env()
+    return _controller
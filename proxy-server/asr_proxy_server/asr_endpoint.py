@@ -1,94 +1,449 @@
 """ASR EndPoint"""
 import asyncio
-from asyncio import Task
+from asyncio import Queue
+from dataclasses import dataclass
+import logging
 import random
 from typing import (
-    Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Union)
+    Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union)
 
-# from asr_proxy_server.dummy_engine import DummyEngine as GoogleSpeechToTextV1
+import numpy as np
+
+from asr_proxy_server import metrics
+from asr_proxy_server.admission import get_controller
 from asr_proxy_server.engine_base import (
-    Engine, SpeechRecognitionConfig, SpeechRecognitionDone,
-    SpeechRecognitionError, SpeechRecognitionResultList)
-from asr_proxy_server.google_speech_to_text import GoogleSpeechToTextV1
-from asr_proxy_server.libogg import Ogg
+    Engine, SpeechRecognitionAlternativeWords, SpeechRecognitionConfig,
+    SpeechRecognitionDone, SpeechRecognitionError, SpeechRecognitionErrorCode,
+    SpeechRecognitionResultList)
+from asr_proxy_server.engine_registry import ENGINES
+from asr_proxy_server.fanout_engine import FanOutEngine
+from asr_proxy_server.ingest import (
+    OPUS_SAMPLE_RATES, AudioFormat, OpusFramer, PcmIngest)
+from asr_proxy_server.interim_throttle import InterimThrottle
 from asr_proxy_server.opus import (
-    get_opus_framesize_from_toc, opus_comment_header_packet,
-    opus_header_packet)
+    InvalidOpusPacket, OggMuxer, opus_comment_header_packet,
+    opus_header_packet, opus_packet_samples)
+from asr_proxy_server.result_cache import CachingEngine
+from asr_proxy_server.streaming_engine import (
+    StreamingEngine, TaskGroup, as_streaming_engine)
+from asr_proxy_server.vad import GranuleMap, SilenceTrimmer
+
+# max audio (ogg pages / pcm arrays) buffered for the engine
+AUDIO_QUEUE_SIZE = 8
+_TICK = object()  # `timer` event
+
+
+@dataclass
+class EndpointConfig:
+    """Per-session options of the endpoint itself (not of the engine).
+
+    These are taken out of the `engine-config` object before the rest is
+    passed to `SpeechRecognitionConfig.parse`.
+    """
+    page_packets: int  # max opus packets per ogg page
+    page_duration: int  # max audio duration per ogg page [ms] (0: no limit)
+    page_latency: int  # max delay of a partially filled page [ms]
+    vad: bool  # drop long silent stretches before sending upstream
+    vad_threshold: float  # speech energy threshold [dBFS]
+    vad_hangover: int  # silence kept after speech [ms]
+    vad_preroll: int  # silence restored before speech [ms]
+    interim_interval: int  # min interval between interim results [ms]
+    interim_delta: bool  # send only the changed suffix of transcripts
+    cache: bool  # reuse final results of identical audio (no interims)
+    receive_timeout: int  # max wait for the next audio packet [ms] (0: none)
+    final_timeout: int  # max wait for the end after the audio [ms] (0: none)
+
+    @staticmethod
+    def parse(cfg: Dict[str, Any]) -> 'EndpointConfig':
+        return EndpointConfig(
+            page_packets=max(1, int(cfg.pop('page_packets', 1))),
+            page_duration=max(0, int(cfg.pop('page_duration', 0))),
+            page_latency=max(0, int(cfg.pop('page_latency', 100))),
+            vad=bool(cfg.pop('vad', False)),
+            vad_threshold=float(cfg.pop('vad_threshold', -50.0)),
+            vad_hangover=max(0, int(cfg.pop('vad_hangover', 500))),
+            vad_preroll=max(0, int(cfg.pop('vad_preroll', 200))),
+            interim_interval=max(0, int(cfg.pop('interim_interval', 0))),
+            interim_delta=bool(cfg.pop('interim_delta', False)),
+            cache=bool(cfg.pop('cache', False)),
+            receive_timeout=max(0, int(cfg.pop('receive_timeout', 0))),
+            final_timeout=max(0, int(cfg.pop('final_timeout', 0))),
+        )
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionLogger(logging.LoggerAdapter):
+    """Prefixes messages with the session id (also set as `record.session`).
+    """
+
+    def process(self, msg: Any, kwargs: Any) -> Any:
+        kwargs.setdefault('extra', {}).update(self.extra)
+        return '[{}] {}'.format(self.extra['session'], msg), kwargs
 
 
 async def asr_endpoint(
         header: Dict[str, Any],
         receive_bytes: Callable[[], Awaitable[bytes]],
+        session_id: Optional[str] = None,
 ) -> AsyncIterator[Union[SpeechRecognitionResultList, SpeechRecognitionDone,
                          SpeechRecognitionError]]:
-    # build ogg opus headers
-    header_pages: List[bytes] = []
-    granulepos = header['pre_skip']
-    ogg = Ogg(random.randint(-2**31, 2**31-1))
-    ogg.packetin(opus_header_packet(
-        n_channels=1, pre_skip=granulepos, input_sample_rate=48000
-    ), 0, b_o_s=True)
-    header_pages.append(ogg.flush())  # type: ignore
-    ogg.packetin(opus_comment_header_packet(
-        header['version'] + ', WebAssembly'), 0)
-    header_pages.append(ogg.flush())  # type: ignore
-
-    # instantiate recognition engine
-    engine: Engine = {
-        'google-v1': GoogleSpeechToTextV1,
-    }[header.get('engine', 'google-v1')]()
-    await engine.init(SpeechRecognitionConfig.parse(
-        header.get('engine-config', {})))
-
-    print('[ASR:WebSocket] Initialized:', header)
-
-    async def _process_opus_packet(packet: bytes) -> None:
-        nonlocal header_pages, granulepos
-        if header_pages:
-            for hpage in header_pages:
-                await engine.write_ogg_opus_page(hpage)
+    log = SessionLogger(logger, {
+        'session': session_id or '{:08x}'.format(random.getrandbits(32))})
+    engine_config = dict(header.get('engine-config', {}))
+    config = EndpointConfig.parse(engine_config)
+    audio_format = AudioFormat.parse(header)
+    loop = asyncio.get_event_loop()
+    if audio_format.encoding == 'opus':
+        pre_skip = header['pre_skip']
+        version = header['version'] + ', WebAssembly'
+    else:
+        pre_skip, version = 0, ''  # of the opus encoder (if used)
+
+    # wait for a session slot of every engine before loading the engines
+    # or reading any audio (a list of engine names races them)
+    engine_name = header.get('engine', 'google-v1')
+    engine_names = engine_name if isinstance(engine_name, list) \
+        else [engine_name]
+    admission = get_controller()
+    try:
+        for name in engine_names:
+            if not isinstance(name, str) or name not in ENGINES:
+                raise SpeechRecognitionError(
+                    SpeechRecognitionErrorCode.ServiceNotAllowed,
+                    'unsupported engine: {}'.format(name))
+        await admission.acquire(engine_names)
+    except SpeechRecognitionError as e:
+        log.warning('rejected: %s', e.message)
+        metrics.errors.inc(1, e.error.value)
+        yield e
+        return
+
+    engine: Union[Engine, StreamingEngine]
+    ingest: Optional[PcmIngest] = None
+    framer: Optional[OpusFramer] = None
+    decoder: Any = None
+    pcm_skip = 0
+    try:
+        # instantiate recognition engine
+        if isinstance(engine_name, list):
+            engine = FanOutEngine(
+                [(await ENGINES.load(name))() for name in engine_name])
+            engine_name = '+'.join(engine_name)
+        else:
+            engine = (await ENGINES.load(engine_name))()
+        if config.cache:
+            engine = CachingEngine(engine, engine_name)  # type: ignore
+        stream = as_streaming_engine(engine)
+
+        # raw PCM / mu-law audio is resampled to the rate of PcmEngines,
+        # and encoded to opus (at the client's rate if opus supports it)
+        # otherwise
+        if audio_format.encoding != 'opus':
+            fs = stream.pcm_sample_rate
+            if not fs:
+                fs = audio_format.sample_rate \
+                    if audio_format.sample_rate in OPUS_SAMPLE_RATES \
+                    else 48000
+                framer = OpusFramer(fs)
+                pre_skip, version = framer.pre_skip, framer.version
+            ingest = PcmIngest(audio_format, fs)
+
+        # PcmEngines get decoded audio directly instead of ogg pages
+        if stream.pcm_sample_rate and ingest is None:
+            from asr_proxy_server.libopus import OpusDecoder
+            decoder = OpusDecoder(stream.pcm_sample_rate, 1)
+            pcm_skip = pre_skip * stream.pcm_sample_rate // 48000
+
+        # build ogg opus headers
+        header_pages: List[bytes] = []
+        granulepos = pre_skip
+        ogg = OggMuxer(random.randint(-2**31, 2**31-1))
+        ogg.packetin(opus_header_packet(
+            n_channels=1, pre_skip=granulepos, input_sample_rate=48000
+        ), 0, b_o_s=True)
+        header_pages.append(ogg.flush())  # type: ignore
+        ogg.packetin(opus_comment_header_packet(version), 0)
+        header_pages.append(ogg.flush())  # type: ignore
+
+        # packets dropped by the trimmer do not advance granulepos, so the
+        # forwarded stream stays a valid (shorter) ogg opus stream.
+        # word timings of the engine are mapped back to the client's granule
+        # positions (`client_granulepos`: end of the last received packet).
+        # (PCM passed through to PcmEngines is not trimmed)
+        trimmer: Optional[SilenceTrimmer] = None
+        granule_map: Optional[GranuleMap] = None
+        client_granulepos = granulepos
+        if config.vad and (ingest is None or framer is not None):
+            trimmer = SilenceTrimmer(
+                threshold=config.vad_threshold, hangover=config.vad_hangover,
+                preroll=config.vad_preroll)
+            granule_map = GranuleMap()
+
+        throttle: Optional[InterimThrottle] = None
+        if config.interim_interval or config.interim_delta:
+            throttle = InterimThrottle(
+                min_interval=config.interim_interval / 1000,
+                delta=config.interim_delta)
+    except BaseException:
+        admission.release(engine_names)
+        raise
+    metrics.sessions.inc(1, engine_name)
+
+    # packets are batched into one ogg page until `page_packets` packets or
+    # `page_duration` of audio are buffered, or `page_latency` has elapsed
+    # since the first buffered packet.
+    max_batch_samples = config.page_duration * 48 or float('inf')
+    n_batched_packets, n_batched_samples = 0, 0
+    batch_deadline: Optional[float] = None
+    batch_received_at = 0.0  # receive time of the first batched packet
+
+    # timestamps for latency metrics
+    first_write_at: Optional[float] = None
+    end_of_audio_at: Optional[float] = None
+    interim_observed = False
+
+    # the session runs in one task (`_session`) of two children: `_feed`
+    # writes the client's audio to `audio`, which the engine iterates, and
+    # the engine's results are put into `events`. The generator below
+    # consumes `events`, which also receives the ticks of `timer` (page
+    # latency and interim throttle deadlines) and timeout errors.
+    audio: Queue = Queue(AUDIO_QUEUE_SIZE)  # None: end of audio
+    events: Queue = Queue()
+    write_lock = asyncio.Lock()  # keeps pages of concurrent flushes in order
+    timer: Optional[asyncio.TimerHandle] = None
+    timeout: Optional[asyncio.TimerHandle] = None
+    receiving_since: Optional[float] = None  # waiting for the client
+    audio_ended_at: Optional[float] = None
+
+    def _on_timer() -> None:
+        nonlocal timer
+        timer = None
+        events.put_nowait(_TICK)
+
+    def _schedule(when: Optional[float]) -> None:
+        nonlocal timer
+        if when is None or (timer is not None and timer.when() <= when):
+            return
+        if timer is not None:
+            timer.cancel()
+        timer = loop.call_at(when, _on_timer)
+
+    def _check_timeout() -> None:
+        # one timer per session, pushed back while the deadline moves
+        nonlocal timeout
+        timeout = None
+        if audio_ended_at is None:
+            limit, what = config.receive_timeout, 'audio'
+            since = loop.time() if receiving_since is None \
+                else receiving_since
+        else:
+            limit, what = config.final_timeout, 'final result'
+            since = audio_ended_at
+        if not limit:
+            return
+        deadline = since + limit / 1000
+        if loop.time() < deadline:
+            timeout = loop.call_at(deadline, _check_timeout)
+        else:
+            events.put_nowait(SpeechRecognitionError(
+                SpeechRecognitionErrorCode.Aborted,
+                'no {} for {}ms'.format(what, limit)))
+
+    async def _audio() -> AsyncIterator[Any]:
+        while True:
+            data = await audio.get()
+            if data is None:
+                return
+            yield data
+
+    async def _write_pages() -> None:
+        nonlocal n_batched_packets, n_batched_samples, batch_deadline
+        nonlocal first_write_at
+        async with write_lock:
+            pages = header_pages[:]
             header_pages.clear()
-        granulepos += (
-            get_opus_framesize_from_toc(packet[0]) * 48000 // 1000)
+            while True:
+                page = ogg.flush()
+                if not page:
+                    break
+                pages.append(page)
+            n_batched_packets, n_batched_samples = 0, 0
+            batch_deadline = None
+            if not pages:
+                return
+            data = b''.join(pages)
+            start = loop.time()
+            metrics.receive_to_page.observe(start - batch_received_at)
+            metrics.engine_queue_depth.observe(stream.queue_depth)
+            await audio.put(data)
+            metrics.upstream_bytes.inc(len(data))
+            if first_write_at is None:
+                first_write_at = start
+
+    async def _write_pcm(pcm: np.ndarray) -> None:
+        nonlocal first_write_at
+        start = loop.time()
+        metrics.engine_queue_depth.observe(stream.queue_depth)
+        await audio.put(pcm)
+        metrics.upstream_bytes.inc(pcm.nbytes)
+        if first_write_at is None:
+            first_write_at = start
+
+    async def _process_opus_packet(packet: bytes, n_samples: int) -> None:
+        nonlocal granulepos, batch_deadline, batch_received_at
+        nonlocal n_batched_packets, n_batched_samples, pcm_skip
+        granulepos += n_samples
+        if decoder is not None:
+            pcm = decoder.decode(packet)
+            if pcm_skip:
+                pcm, pcm_skip = pcm[pcm_skip:], max(0, pcm_skip - len(pcm))
+            await _write_pcm(pcm.copy())  # the decoder reuses its buffer
+            return
         ogg.packetin(packet, granulepos)
+        n_batched_packets += 1
+        n_batched_samples += n_samples
+        if batch_deadline is None:
+            batch_received_at = loop.time()
+            batch_deadline = batch_received_at + config.page_latency / 1000
+            _schedule(batch_deadline)
+        if (n_batched_packets >= config.page_packets
+                or n_batched_samples >= max_batch_samples):
+            await _write_pages()
+
+    async def _receive_opus_packet(packet: bytes) -> None:
+        nonlocal client_granulepos
+        try:
+            n_samples = opus_packet_samples(packet)
+        except InvalidOpusPacket as e:
+            # never pass broken framing to the muxer / decoder
+            log.warning('dropped malformed opus packet: %s', e)
+            metrics.malformed_packets.inc()
+            return
+        client_granulepos += n_samples
+        if trimmer is None:
+            await _process_opus_packet(packet, n_samples)
+            return
+        # forwarded packets are contiguous audio ending at
+        # `client_granulepos`
+        start = granulepos
+        for p in trimmer.process(packet):
+            await _process_opus_packet(p, opus_packet_samples(p))
+        if granulepos != start:
+            granule_map.add(  # type: ignore
+                start, client_granulepos - granulepos)
+
+    async def _feed() -> None:
+        nonlocal receiving_since, end_of_audio_at, audio_ended_at
         while True:
-            page = ogg.flush()
-            if not page:
+            # a receive error (e.g. the client disconnected) aborts the
+            # session; only an empty message ends the audio
+            receiving_since = loop.time()
+            packet = await receive_bytes()
+            receiving_since = None
+            if not packet:
                 break
-            await engine.write_ogg_opus_page(page)
+            metrics.received_bytes.inc(len(packet))
+            if ingest is None:
+                await _receive_opus_packet(packet)
+            elif framer is None:
+                pcm = ingest.process(packet)
+                if len(pcm):
+                    await _write_pcm(pcm)
+            else:
+                for p in framer.encode(ingest.process(packet)):
+                    await _receive_opus_packet(p)
+        if framer is not None:
+            for p in framer.flush():
+                await _receive_opus_packet(p)
+        if n_batched_packets:
+            await _write_pages()
+        end_of_audio_at = audio_ended_at = loop.time()
+        if timeout is None:
+            _check_timeout()
+        await audio.put(None)
 
-    try:
-        ws_recv_task: Task = asyncio.create_task(receive_bytes())
-        engine_recv_task: Optional[Task] = None
-        tasks: Set[Task] = {ws_recv_task}
+    async def _session() -> None:
+        # errors are passed to the generator as events, so that they are
+        # raised as is (not as an ExceptionGroup of the TaskGroup)
+        async def _feed_events() -> None:
+            try:
+                await _feed()
+            except Exception as e:
+                events.put_nowait(e)
+
+        async with TaskGroup() as tg:
+            feeder = tg.create_task(_feed_events())
+            try:
+                async for resp in stream.recognize(
+                        SpeechRecognitionConfig.parse(engine_config),
+                        _audio()):
+                    events.put_nowait(resp)
+            except Exception as e:
+                events.put_nowait(e)
+            feeder.cancel()  # the client may still be sending
 
+    metrics.active_sessions.inc(1)
+    runner = asyncio.ensure_future(_session())
+    log.info('initialized: %s', header)
+    try:
+        _check_timeout()
         while True:
-            done, pending = await asyncio.wait(
-                tasks, return_when=asyncio.FIRST_COMPLETED)
-            tasks = pending  # type: ignore
-            if ws_recv_task in done:
-                try:
-                    packet = ws_recv_task.result()
-                except Exception:
-                    packet = None
-                if packet:
-                    await _process_opus_packet(packet)
-                    ws_recv_task = asyncio.create_task(receive_bytes())
-                    tasks.add(ws_recv_task)
-                else:
-                    await engine.done()
-            if engine_recv_task in done:
-                try:
-                    resp = engine_recv_task.result()
-                except SpeechRecognitionError as e:
-                    yield e
-                    return
+            event = await events.get()
+            if event is _TICK:
+                if batch_deadline is not None and \
+                        loop.time() >= batch_deadline:
+                    await _write_pages()
+                _schedule(batch_deadline)
+                if throttle is not None:
+                    for results in throttle.poll(loop.time()):
+                        yield results
+                    _schedule(throttle.deadline)
+                continue
+            if isinstance(event, SpeechRecognitionError):
+                log.warning('error: %s %s', event.error.value, event.message)
+                metrics.errors.inc(1, event.error.value)
+                yield event
+                return
+            if isinstance(event, BaseException):
+                raise event
+            resp = event
+            if isinstance(resp, SpeechRecognitionDone):
+                if throttle is not None:
+                    for results in throttle.flush(loop.time()):
+                        yield results
+                yield resp
+                return
+            if first_write_at is not None and not interim_observed and \
+                    any(not r.is_final for r in resp):
+                interim_observed = True
+                metrics.time_to_first_interim.observe(
+                    loop.time() - first_write_at)
+            if end_of_audio_at is not None and \
+                    any(r.is_final for r in resp):
+                metrics.time_to_final.observe(loop.time() - end_of_audio_at)
+                end_of_audio_at = None
+            if granule_map is not None:
+                for r in resp:
+                    for alt in r.alternatives:
+                        if isinstance(alt, SpeechRecognitionAlternativeWords):
+                            granule_map.map_words(alt.words)
+            if throttle is None:
                 yield resp
-                if isinstance(resp, SpeechRecognitionDone):
-                    return
-                engine_recv_task = None
-            if engine_recv_task is None:
-                engine_recv_task = asyncio.create_task(engine.get_result())
-                tasks.add(engine_recv_task)
+            else:
+                for results in throttle.push(resp, loop.time()):
+                    yield results
+                _schedule(throttle.deadline)
     finally:
-        await engine.close()
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        for handle in (timer, timeout):
+            if handle is not None:
+                handle.cancel()
+        admission.release(engine_names)
+        metrics.active_sessions.inc(-1)
+        if trimmer is not None:
+            metrics.vad_dropped_seconds.inc(trimmer.dropped_seconds)
+            log.info('VAD dropped %.2fs of silence', trimmer.dropped_seconds)
+        log.info('closed')
@@ -1,4 +1,6 @@
+import asyncio
 from asyncio import Queue
+import logging
 from typing import Union
 
 from asr_proxy_server.engine_base import (
@@ -6,16 +8,20 @@ from asr_proxy_server.engine_base import (
     SpeechRecognitionDone, SpeechRecognitionError, SpeechRecognitionResult,
     SpeechRecognitionResultList)
 
+logger = logging.getLogger(__name__)
+
 
 class DummyEngine(Engine):
-    def __init__(self) -> None:
+    def __init__(self, delay: float = 0.0) -> None:
+        self._delay = delay  # seconds until each result is returned
         self._n_pages = 0
         self._queue: Queue[Union[
             SpeechRecognitionResultList, SpeechRecognitionDone,
             SpeechRecognitionError]] = Queue()
 
     async def init(self, config: SpeechRecognitionConfig) -> None:
-        print('[INIT]', config)
+        logger.debug('init: %s', config)
+        self._delay = config.engine.get('delay', self._delay)
 
     async def write_ogg_opus_page(self, data: bytes) -> None:
         self._n_pages += 1
@@ -27,19 +33,22 @@ class DummyEngine(Engine):
                     confidence=0.98)])])
 
     async def done(self) -> None:
-        print('[DONE]')
+        logger.debug('done')
         self._queue.put_nowait([SpeechRecognitionResult(
             is_final=True,
             alternatives=[SpeechRecognitionAlternative(
                 transcript='あ' * (self._n_pages // 30),
                 confidence=0.98)])])
+        self._queue.put_nowait(SpeechRecognitionDone())
 
     async def get_result(self) -> Union[
             SpeechRecognitionResultList, SpeechRecognitionDone]:
         ret = await self._queue.get()
+        if self._delay:
+            await asyncio.sleep(self._delay)
         if isinstance(ret, SpeechRecognitionError):
             raise ret
         return ret
 
     async def close(self) -> None:
-        print('[CLOSE]')
+        logger.debug('close')
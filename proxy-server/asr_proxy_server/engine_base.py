@@ -1,9 +1,17 @@
 """ASR Engine base class definitions."""
 from abc import ABC, abstractmethod
+from array import array
 from dataclasses import asdict, dataclass
 from enum import Enum
+from json.encoder import encode_basestring
+import math
+import struct
 from typing import Any, Dict, List, Optional, Union
 
+import numpy as np
+
+from asr_proxy_server.opus import iter_ogg_packets
+
 
 @dataclass
 class SpeechRecognitionConfig:
@@ -24,26 +32,76 @@ class SpeechRecognitionConfig:
         )
 
 
+def json_float(v: float) -> str:
+    """Encode a float like `json.dumps(v, allow_nan=False)`."""
+    if not math.isfinite(v):
+        raise ValueError('Out of range float values are not JSON compliant')
+    return float.__repr__(float(v))
+
+
+# Results are slotted dataclasses: they are created for every engine response
+# and `to_json` writes them without going through `asdict` and `json.dumps`.
+
 @dataclass
 class SpeechRecognitionAlternative:
+    __slots__ = ('transcript', 'confidence')
     transcript: str
     confidence: float
 
+    def to_json(self) -> str:
+        return '{"transcript":%s,"confidence":%s}' % (
+            encode_basestring(self.transcript), json_float(self.confidence))
+
+
+@dataclass
+class WordTimings:
+    """Words of an alternative as parallel arrays.
+
+    `start` / `end` are granule positions (48kHz samples including the
+    client's pre_skip) of the client's audio.
+    """
+    __slots__ = ('words', 'start', 'end')
+    words: List[str]
+    start: 'array[int]'
+    end: 'array[int]'
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def to_json(self) -> str:
+        return '{"word":[%s],"start":[%s],"end":[%s]}' % (
+            ','.join([encode_basestring(w) for w in self.words]),
+            ','.join(map(str, self.start)), ','.join(map(str, self.end)))
+
+    @staticmethod
+    def from_dict(obj: Dict[str, Any]) -> 'WordTimings':
+        return WordTimings(
+            obj['word'], array('q', obj['start']), array('q', obj['end']))
+
+
+@dataclass
+class SpeechRecognitionAlternativeWords(SpeechRecognitionAlternative):
+    __slots__ = ('words',)
+    words: WordTimings
+
+    def to_json(self) -> str:
+        return super().to_json()[:-1] + ',"words":%s}' % self.words.to_json()
+
 
 @dataclass
 class SpeechRecognitionResult:
+    __slots__ = ('alternatives', 'is_final')
     alternatives: List[SpeechRecognitionAlternative]
     is_final: bool
 
-    def to_dict(self) -> Dict[str, Any]:
-        def remove_none(o):
-            for k in [k for k, v in o.items() if v is None]:
-                o.pop(k)
-            return o
-        obj = remove_none(asdict(self))
-        for alt in obj['alternatives']:
-            remove_none(alt)
-        return obj
+    def to_json(self) -> str:
+        return '{"alternatives":[%s],"is_final":%s%s}' % (
+            ','.join([alt.to_json() for alt in self.alternatives]),
+            'true' if self.is_final else 'false', self._to_json_extra())
+
+    def _to_json_extra(self) -> str:
+        """JSON members of subclass fields (starting with a comma)."""
+        return ''
 
 
 SpeechRecognitionResultList = List[SpeechRecognitionResult]
@@ -77,6 +135,21 @@ class SpeechRecognitionDone:
 
 
 class Engine(ABC):
+    @classmethod
+    async def startup(cls) -> None:
+        """Called once per process on server startup."""
+        pass
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        """Called once per process on server shutdown."""
+        pass
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of buffered requests not yet sent upstream (metrics)."""
+        return 0
+
     @abstractmethod
     async def init(self, config: SpeechRecognitionConfig) -> None:
         pass
@@ -97,3 +170,44 @@ class Engine(ABC):
     @abstractmethod
     async def close(self) -> None:
         pass
+
+
+class PcmEngine(Engine):
+    """Engine that takes decoded audio instead of ogg pages.
+
+    asr_endpoint decodes the opus packets of the session and passes mono
+    int16 samples at `sample_rate` to `write_pcm`. `write_ogg_opus_page`
+    is implemented on top of it for callers that only forward pages
+    (e.g. FanOutEngine). `pcm` may be a view of the decoder's buffer and
+    is only valid until `write_pcm` returns.
+    """
+    sample_rate = 16000
+
+    def __init__(self) -> None:
+        # state of `write_ogg_opus_page` (the decoder is created on use)
+        self._page_decoder: Any = None
+        self._page_skip = 0
+
+    @abstractmethod
+    async def write_pcm(self, pcm: np.ndarray) -> None:
+        pass
+
+    async def write_ogg_opus_page(self, page: bytes) -> None:
+        if self._page_decoder is None:
+            from asr_proxy_server.libopus import OpusDecoder
+            self._page_decoder = OpusDecoder(self.sample_rate, 1)
+        for packet in iter_ogg_packets(page):
+            if packet.startswith(b'OpusHead'):
+                # pre_skip is in 48kHz samples
+                self._page_skip = struct.unpack_from(
+                    '<H', packet, 10)[0] * self.sample_rate // 48000
+                continue
+            if packet.startswith(b'OpusTags'):
+                continue
+            pcm = self._page_decoder.decode(packet)
+            if self._page_skip:
+                skip = self._page_skip
+                self._page_skip = max(0, skip - len(pcm))
+                pcm = pcm[skip:]
+            if len(pcm):
+                await self.write_pcm(pcm)
@@ -0,0 +1,119 @@
+"""Registry of recognition engines, imported on first use.
+
+Engines are registered as `module:ClassName` strings (the built-in ones
+below, and those of the `asr_proxy_server.engines` entry point group of
+installed packages) and imported the first time a session uses them. The
+`Engine.startup` hook of an engine class runs once, before its first
+session; engines listed in `ASR_PRELOAD_ENGINES` (comma separated) are
+loaded when the server starts instead.
+"""
+import asyncio
+import importlib
+import os
+from typing import Dict, Iterator, List, Optional, Type, Union
+
+from asr_proxy_server.engine_base import Engine
+
+ENTRY_POINT_GROUP = 'asr_proxy_server.engines'
+
+BUILTIN_ENGINES = {
+    'google-v1':
+    'asr_proxy_server.google_speech_to_text:GoogleSpeechToTextV1',
+    'google-v1p1beta1':
+    'asr_proxy_server.google_speech_to_text:GoogleSpeechToTextV1p1beta1',
+    'local-ctc': 'asr_proxy_server.local_ctc_engine:LocalCtcEngine',
+    'dummy': 'asr_proxy_server.dummy_engine:DummyEngine',  # for load tests
+}
+
+
+def _entry_points() -> Dict[str, str]:
+    from importlib import metadata
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        group = eps.select(group=ENTRY_POINT_GROUP)  # type: ignore
+    else:  # python < 3.10
+        group = eps.get(ENTRY_POINT_GROUP, [])  # type: ignore
+    return {ep.name: ep.value for ep in group}
+
+
+class EngineRegistry(object):
+    def __init__(self, specs: Optional[Dict[str, str]] = None,
+                 entry_points: bool = True) -> None:
+        self._specs: Dict[str, Union[str, Type[Engine]]] = dict(specs or {})
+        self._entry_points = entry_points  # not scanned yet
+        self._classes: Dict[str, Type[Engine]] = {}
+        self._started: Dict[Type[Engine], asyncio.Future] = {}
+
+    def _discover(self) -> None:
+        # scanning the installed distributions is deferred until a name
+        # is not found (registered names take precedence)
+        if self._entry_points:
+            self._entry_points = False
+            for name, spec in _entry_points().items():
+                self._specs.setdefault(name, spec)
+
+    def register(self, name: str, engine: Union[str, Type[Engine]]) -> None:
+        """Register an engine class or its `module:ClassName`."""
+        self._specs[name] = engine
+        self._classes.pop(name, None)
+
+    def names(self) -> List[str]:
+        self._discover()
+        return sorted(self._specs)
+
+    def __contains__(self, name: object) -> bool:
+        if name not in self._specs:
+            self._discover()
+        return name in self._specs
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names())
+
+    def __getitem__(self, name: str) -> Type[Engine]:
+        """The engine class of `name` (imported, but not started)."""
+        cls = self._classes.get(name)
+        if cls is not None:
+            return cls
+        if name not in self:
+            raise KeyError(name)
+        spec = self._specs[name]
+        if isinstance(spec, str):
+            module, _, attr = spec.partition(':')
+            cls = getattr(importlib.import_module(module), attr)
+        else:
+            cls = spec
+        self._classes[name] = cls  # type: ignore
+        return cls  # type: ignore
+
+    async def load(self, name: str) -> Type[Engine]:
+        """The engine class of `name`, started once per process."""
+        cls = self[name]
+        started = self._started.get(cls)
+        if started is None:
+            started = self._started[cls] = asyncio.ensure_future(
+                cls.startup())
+        try:
+            await asyncio.shield(started)
+        except Exception:
+            if self._started.get(cls) is started:
+                del self._started[cls]  # retried by the next session
+            raise
+        return cls
+
+    async def preload(self, names: Optional[List[str]] = None) -> None:
+        """Load `names` (default: ASR_PRELOAD_ENGINES)."""
+        if names is None:
+            names = [n for n in os.environ.get(
+                'ASR_PRELOAD_ENGINES', '').split(',') if n]
+        for name in names:
+            await self.load(name)
+
+    async def shutdown(self) -> None:
+        """Call `Engine.shutdown` of the started engine classes."""
+        started, self._started = self._started, {}
+        for cls, fut in started.items():
+            if fut.done() and not fut.cancelled() and not fut.exception():
+                await cls.shutdown()
+
+
+ENGINES = EngineRegistry(BUILTIN_ENGINES)
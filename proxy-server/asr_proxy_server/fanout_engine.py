@@ -0,0 +1,150 @@
+import asyncio
+from asyncio import Queue, QueueFull, Task
+import logging
+from typing import Awaitable, Dict, List, Optional, Sequence, Union
+
+from asr_proxy_server.engine_base import (
+    Engine, SpeechRecognitionConfig, SpeechRecognitionDone,
+    SpeechRecognitionResultList)
+
+logger = logging.getLogger(__name__)
+
+
+class FanOutEngine(Engine):
+    """Races several engines on the same audio.
+
+    Every ogg page is written (by reference) to all engines and their
+    results are merged. Interim results of any engine are passed through
+    until one of them returns a final result; that engine wins, the others
+    are cancelled and closed, and only the winner is used afterwards.
+
+    Each engine is written by its own task from a queue of at most
+    `max_queued_pages` pages, so that a slow engine does not delay the
+    others; an engine whose queue is full is dropped (unless it is the
+    last one, which blocks the writer as a single engine would). Engines
+    failing with an exception are dropped as well; the error is raised
+    when no engines are left.
+    """
+
+    def __init__(self, engines: Sequence[Engine],
+                 max_queued_pages: int = 64) -> None:
+        if not engines:
+            raise ValueError('no engines')
+        self._engines: List[Engine] = list(engines)
+        self._tasks: Dict[Task, Engine] = {}
+        self._max_queued_pages = max_queued_pages
+        self._queues: Dict[Engine, Queue] = {}  # None: end of audio
+        self._writers: Dict[Engine, Task] = {}
+        self._error: Optional[Exception] = None  # of the last dropped engine
+
+    async def _all(self, coros: Sequence[Awaitable[None]]) -> None:
+        engines = list(self._engines)
+        rets = await asyncio.gather(*coros, return_exceptions=True)
+        for e, r in zip(engines, rets):
+            if isinstance(r, Exception):
+                if e in self._engines:
+                    await self._drop(e, r)
+            elif isinstance(r, BaseException):
+                raise r
+        self._check()
+
+    def _check(self) -> None:
+        if not self._engines:
+            raise self._error  # type: ignore
+
+    async def init(self, config: SpeechRecognitionConfig) -> None:
+        await self._all([e.init(config) for e in self._engines])
+        for e in self._engines:
+            queue: Queue = Queue(self._max_queued_pages)
+            self._queues[e] = queue
+            self._writers[e] = asyncio.create_task(self._write(e, queue))
+
+    async def _write(self, engine: Engine, queue: Queue) -> None:
+        try:
+            while True:
+                page = await queue.get()
+                if page is None:
+                    await engine.done()
+                    return
+                await engine.write_ogg_opus_page(page)
+        except Exception as e:
+            await self._drop(engine, e)
+
+    async def _put(self, page: Optional[bytes]) -> None:
+        self._check()
+        for e in list(self._engines):
+            if e not in self._engines:
+                continue  # dropped while waiting for another queue
+            if len(self._engines) == 1:
+                await self._queues[e].put(page)
+                continue
+            try:
+                self._queues[e].put_nowait(page)
+            except QueueFull:
+                await self._drop(e, QueueFull(
+                    '{} queued pages'.format(self._max_queued_pages)))
+        self._check()
+
+    async def write_ogg_opus_page(self, page: bytes) -> None:
+        await self._put(page)
+
+    async def done(self) -> None:
+        await self._put(None)
+
+    async def get_result(self) -> Union[
+            SpeechRecognitionResultList, SpeechRecognitionDone]:
+        while True:
+            self._check()
+            running = set(self._tasks.values())
+            for e in self._engines:
+                if e not in running:
+                    self._tasks[asyncio.create_task(e.get_result())] = e
+            done, _ = await asyncio.wait(
+                self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            # handle one result per call; other completed tasks are
+            # picked up by the next call.
+            task = next(iter(done))
+            engine = self._tasks.pop(task, None)
+            if engine is None:
+                continue  # dropped (by its writer) while waiting
+            try:
+                resp = task.result()
+            except Exception as e:
+                # e.g. google.api_core errors of one of the engines
+                await self._drop(engine, e)
+                continue
+            if isinstance(resp, SpeechRecognitionDone):
+                # finished without a final result
+                await self._drop(engine)
+                if not self._engines:
+                    return resp
+                continue
+            if any(r.is_final for r in resp):
+                await asyncio.gather(*[
+                    self._drop(e) for e in self._engines if e is not engine])
+            return resp
+
+    async def _drop(self, engine: Engine,
+                    error: Optional[Exception] = None) -> None:
+        if engine not in self._engines:
+            return  # dropped concurrently
+        if error is not None:
+            logger.warning('dropped %s: %r', type(engine).__name__, error)
+            self._error = error
+        self._engines.remove(engine)
+        for task in [t for t, e in self._tasks.items() if e is engine]:
+            task.cancel()
+            del self._tasks[task]
+        writer = self._writers.pop(engine, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+        queue = self._queues.pop(engine, None)
+        while queue is not None and not queue.empty():
+            queue.get_nowait()  # wakes up a blocked `_put`
+        try:
+            await engine.close()
+        except Exception:
+            pass
+
+    async def close(self) -> None:
+        await asyncio.gather(*[self._drop(e) for e in list(self._engines)])
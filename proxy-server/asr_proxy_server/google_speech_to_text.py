@@ -1,23 +1,153 @@
+from array import array
+import asyncio
 from asyncio import Queue
+from collections import deque
 from dataclasses import dataclass
-from typing import Any, AsyncIterator, Dict, Optional, Sequence, Tuple, Union
+import importlib
+import logging
+import os
+import struct
+from typing import (
+    Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Sequence, Tuple,
+    Union)
 
+from asr_proxy_server import metrics
 from asr_proxy_server.engine_base import (
-    Engine, SpeechRecognitionAlternative, SpeechRecognitionConfig,
-    SpeechRecognitionDone)
-from asr_proxy_server.engine_base import SpeechRecognitionResultList
+    Engine, SpeechRecognitionAlternative, SpeechRecognitionAlternativeWords,
+    SpeechRecognitionConfig, SpeechRecognitionDone)
 from asr_proxy_server.engine_base import \
     SpeechRecognitionResult as SpeechRecognitionResultBase
+from asr_proxy_server.engine_base import (
+    SpeechRecognitionResultList, WordTimings, json_float)
+from asr_proxy_server.opus import iter_ogg_page_bytes, restamp_ogg_page
+from asr_proxy_server.replay_buffer import ReplayBuffer
+
+logger = logging.getLogger(__name__)
+
+_PAGE_POSITION = struct.Struct('<qII')  # granulepos, serialno, pageno
+_PRE_SKIP = struct.Struct('<H')
 
 
 @dataclass
 class SpeechRecognitionResult(SpeechRecognitionResultBase):
+    __slots__ = ('stability',)
     stability: float
 
+    def _to_json_extra(self) -> str:
+        return ',"stability":' + json_float(self.stability)
+
+
+class SpeechClientPool(object):
+    """Process-wide pool of SpeechAsyncClient shared across sessions.
+
+    Each client owns one gRPC channel. A client is leased to at most
+    `max_streams_per_channel` sessions at once and up to `max_channels`
+    clients are created on demand; sessions wait for a free slot beyond
+    that.
+    """
+
+    def __init__(self, client_factory: Callable[[], Any], *,
+                 max_channels: int = 4,
+                 max_streams_per_channel: int = 100) -> None:
+        self._client_factory = client_factory
+        self._max_channels = max_channels
+        self._max_streams_per_channel = max_streams_per_channel
+        self._clients: List[Any] = []
+        self._n_streams: List[int] = []
+        self._cond: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        # created lazily so that it is bound to the running event loop
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def open(self, n_channels: int = 1) -> None:
+        """Create and connect `n_channels` clients ahead of time."""
+        while len(self._clients) < min(n_channels, self._max_channels):
+            client = self._new_client()
+            await _grpc_channel(client).channel_ready()
+
+    def _new_client(self) -> Any:
+        client = self._client_factory()
+        self._clients.append(client)
+        self._n_streams.append(0)
+        return client
+
+    async def acquire(self) -> Any:
+        async with self._condition():
+            while True:
+                n, i = min(((n, i) for i, n in enumerate(self._n_streams)),
+                           default=(self._max_streams_per_channel, -1))
+                if n < self._max_streams_per_channel:
+                    self._n_streams[i] += 1
+                    return self._clients[i]
+                if len(self._clients) < self._max_channels:
+                    client = self._new_client()
+                    self._n_streams[-1] += 1
+                    return client
+                await self._condition().wait()
+
+    async def release(self, client: Any) -> None:
+        async with self._condition():
+            self._n_streams[self._clients.index(client)] -= 1
+            self._condition().notify()
+
+    async def close(self) -> None:
+        clients, self._clients, self._n_streams = self._clients, [], []
+        for client in clients:
+            await _grpc_channel(client).close()
+
+
+def _grpc_channel(client: Any) -> Any:
+    return client.transport.grpc_channel
+
 
 class GoogleSpeechToTextV1(Engine):
+    _API_MODULE = 'google.cloud.speech_v1'
+    _client_pool: Optional[SpeechClientPool] = None
+
+    @classmethod
+    def client_pool(cls) -> SpeechClientPool:
+        # each API version has its own pool (client classes differ)
+        pool = cls.__dict__.get('_client_pool')
+        if pool is None:
+            V = importlib.import_module(cls._API_MODULE)
+            pool = SpeechClientPool(
+                V.services.speech.SpeechAsyncClient,
+                max_channels=int(os.environ.get(
+                    'ASR_GOOGLE_MAX_CHANNELS', 4)),
+                max_streams_per_channel=int(os.environ.get(
+                    'ASR_GOOGLE_MAX_STREAMS_PER_CHANNEL', 100)))
+            cls.use_client_pool(pool)
+        return pool
+
+    @classmethod
+    def use_client_pool(cls, pool: SpeechClientPool) -> None:
+        cls._client_pool = pool
+
+    @classmethod
+    async def startup(cls) -> None:
+        n_channels = int(os.environ.get('ASR_GOOGLE_PREWARM_CHANNELS', 1))
+        # channel_ready waits until the channel connects, forever if the
+        # endpoint is unreachable (sessions wait for startup)
+        timeout = float(os.environ.get('ASR_GOOGLE_PREWARM_TIMEOUT', 10))
+        try:
+            await asyncio.wait_for(
+                cls.client_pool().open(n_channels), timeout)
+        except Exception as e:
+            # clients are created on demand when the first session arrives
+            logger.warning(
+                '%s: failed to prewarm channels: %r', cls.__name__, e)
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        pool = cls.__dict__.get('_client_pool')
+        if pool is not None:
+            await pool.close()
+
     def __init__(self) -> None:
-        import google.cloud.speech_v1 as V1  # type: ignore
+        V1 = importlib.import_module(self._API_MODULE)
         self._V = V1
         self._streaming_config_keys = [
             ('single_utterance', None),
@@ -32,12 +162,34 @@ class GoogleSpeechToTextV1(Engine):
             ('model', None),
             ('use_enhanced', None),
         ]
-        self._queue: Queue[Optional[V1.StreamingRecognizeRequest]] = Queue()
+        self._queue: Queue[Optional[bytes]] = Queue()
+        self._max_request_bytes = 2**14
+        self._n_pages = 0
+        self._n_requests = 0
         self._client: Optional[V1.services.speech.SpeechAsyncClient] = None
+        self._config_request: Any = None
         self._stream: Optional[Any] = None
         self._resp_iter: Optional[AsyncIterator[Any]] = None
         self._done_flag = False
 
+        # stream rollover (continuous mode only). pages sent to the current
+        # stream are renumbered so that each stream is a valid ogg stream
+        # starting at granulepos `pre_skip`.
+        self._rollover_samples = 0  # audio per stream (0: no rollover)
+        self._replay_samples = 0
+        self._replay: Optional[ReplayBuffer] = None
+        self._header_pages: List[bytes] = []
+        self._pre_skip = 0
+        self._pending: Deque[Optional[bytes]] = deque()  # sent before queue
+        self._n_taken = 0  # audio pages taken out of the queue
+        self._pageno_shift = 0
+        self._granule_shift = 0
+        self._stream_granulepos = 0  # of the last page sent to the stream
+        self._words_end = 0  # granulepos of the end of the last final word
+        self._rollover_pending = False
+        self._n_streams = 0
+        self._request_task: Optional[asyncio.Task] = None
+
     def _parse_config(self, keys: Sequence[Tuple[str, Any]],
                       config: Dict[str, Any]) -> Dict[str, Any]:
         ret = {}
@@ -47,8 +199,34 @@ class GoogleSpeechToTextV1(Engine):
                 ret[key] = v
         return ret
 
+    @property
+    def queue_depth(self) -> int:
+        """Number of ogg pages waiting to be sent to the server."""
+        return self._queue.qsize() + len(self._pending)
+
+    @property
+    def coalescing_ratio(self) -> float:
+        """Average number of ogg pages per StreamingRecognizeRequest."""
+        return self._n_pages / max(1, self._n_requests)
+
     async def init(self, config: SpeechRecognitionConfig) -> None:
-        self._client = self._V.services.speech.SpeechAsyncClient()
+        # pages are coalesced up to `max_request_bytes` per request and at
+        # most `max_queued_pages` are buffered; when the queue is full
+        # write_ogg_opus_page blocks, which in turn stops reading the
+        # websocket.
+        self._queue = Queue(config.engine.get('max_queued_pages', 64))
+        self._max_request_bytes = config.engine.get(
+            'max_request_bytes', self._max_request_bytes)
+        # a stream is limited to ~305s of audio; in continuous mode a new
+        # stream is opened after `rollover_after` seconds, replaying the
+        # audio not yet covered by a final result (up to `replay_window`
+        # seconds).
+        if config.continuous:
+            self._rollover_samples = int(
+                config.engine.get('rollover_after', 280) * 48000)
+            self._replay_samples = int(
+                config.engine.get('replay_window', 30) * 48000)
+        self._client = await self.client_pool().acquire()
         types = self._V.types
         streaming_config = {
             'single_utterance': not config.continuous,
@@ -66,65 +244,230 @@ class GoogleSpeechToTextV1(Engine):
             encoding=types.RecognitionConfig.AudioEncoding.OGG_OPUS,
             sample_rate_hertz=48000,
         ))
-        self._queue.put_nowait(types.StreamingRecognizeRequest(
+        self._config_request = types.StreamingRecognizeRequest(
             streaming_config=types.StreamingRecognitionConfig(
                 config=types.RecognitionConfig(**recognition_config),
-                **streaming_config)))
+                **streaming_config))
+        await self._open_stream()
 
-        async def queue_to_iter() -> AsyncIterator[Any]:
-            while True:
-                q = await self._queue.get()
-                if q is None:
-                    return
-                yield q
-        self._stream = await self._client.streaming_recognize(queue_to_iter())
+    async def _open_stream(self) -> None:
+        assert self._client is not None
+        self._n_streams += 1
+        self._stream = await self._client.streaming_recognize(
+            self._request_iter(self._n_streams))
         self._resp_iter = self._stream.__aiter__()
 
+    async def _request_iter(self, stream_id: int) -> AsyncIterator[Any]:
+        types = self._V.types
+        # the task consuming this iterator; it is not cancelled by grpc
+        # when the call fails, see _rollover.
+        self._request_task = asyncio.current_task()
+        yield self._config_request
+        end_of_stream = False
+        while not end_of_stream and stream_id == self._n_streams:
+            if self._rollover_samples and \
+                    self._stream_granulepos - self._pre_skip >= \
+                    self._rollover_samples:
+                # half-close; get_result opens the next stream when the
+                # server has sent the final results of this one.
+                self._rollover_pending = True
+                return
+            page = await self._next_page()
+            if page is None:
+                return
+            chunks, size = [page], len(page)
+            while self._pending or not self._queue.empty():
+                page = self._next_page_nowait()
+                if page is None:
+                    end_of_stream = True
+                    break
+                if size + len(page) > self._max_request_bytes:
+                    self._pending.appendleft(page)
+                    break
+                chunks.append(page)
+                size += len(page)
+            self._n_pages += len(chunks)
+            self._n_requests += 1
+            yield types.StreamingRecognizeRequest(
+                audio_content=b''.join(chunks))
+
+    async def _next_page(self) -> Optional[bytes]:
+        if self._pending:
+            return self._pending.popleft()
+        return self._prepare_page(await self._queue.get())
+
+    def _next_page_nowait(self) -> Optional[bytes]:
+        if self._pending:
+            return self._pending.popleft()
+        return self._prepare_page(self._queue.get_nowait())
+
+    def _prepare_page(self, page: Optional[bytes]) -> Optional[bytes]:
+        if page is None or self._replay is None:
+            return page
+        granulepos, _, pageno = _PAGE_POSITION.unpack_from(page, 6)
+        if pageno < 2:  # OpusHead / OpusTags
+            return page
+        self._n_taken += 1
+        self._replay.trim(self._n_taken)
+        if self._pageno_shift or self._granule_shift:
+            page = restamp_ogg_page(page, pageno - self._pageno_shift,
+                                    granulepos - self._granule_shift)
+        self._stream_granulepos = granulepos - self._granule_shift
+        return page
+
+    async def _rollover(self) -> None:
+        """Continue the session on a new stream.
+
+        Header pages and the audio sent but not covered by a final result
+        are replayed, renumbered to start a fresh ogg stream.
+        """
+        assert self._replay is not None
+        self._rollover_pending = False
+        if self._stream is not None:
+            self._stream.cancel()
+        task, self._request_task = self._request_task, None
+        if task is not None and not task.done():
+            # stop the old iterator before it takes pages from the queue
+            task.cancel()
+            await asyncio.wait({task})
+        pool = self.client_pool()
+        if self._client is not None:
+            client, self._client = self._client, None
+            await pool.release(client)
+        self._client = await pool.acquire()
+
+        replay = self._replay
+        self._pageno_shift = replay.first_seq
+        self._granule_shift = replay.start_granulepos - self._pre_skip
+        replayed = list(self._header_pages)
+        for page, _ in replay.pages(self._n_taken):
+            granulepos, _, pageno = _PAGE_POSITION.unpack_from(page, 6)
+            replayed.append(restamp_ogg_page(
+                page, pageno - self._pageno_shift,
+                granulepos - self._granule_shift))
+        # pages left in `_pending` (the overflow of the last request, or
+        # the rest of the previous replay) were stamped for the old stream
+        # and are part of the replay
+        self._pending.clear()
+        self._pending.extend(replayed)
+        self._stream_granulepos = self._pre_skip
+        await self._open_stream()
+
+    def _is_stream_limit(self, e: Exception) -> bool:
+        exceptions = importlib.import_module('google.api_core.exceptions')
+        return isinstance(e, exceptions.OutOfRange)
+
     async def write_ogg_opus_page(self, data: bytes) -> None:
         if self._done_flag:
             return
-        self._queue.put_nowait(
-            self._V.types.StreamingRecognizeRequest(audio_content=data))
+        if not self._rollover_samples:
+            await self._queue.put(data)
+            return
+        for page, raw in iter_ogg_page_bytes(data):
+            body = page.body
+            if body[:8] == b'OpusHead':
+                self._pre_skip = _PRE_SKIP.unpack_from(body, 10)[0]
+                self._replay = ReplayBuffer(
+                    self._pre_skip, self._replay_samples)
+                self._header_pages.append(raw)
+            elif body[:8] == b'OpusTags':
+                self._header_pages.append(raw)
+            elif self._replay is not None:
+                self._replay.append(raw, page.granulepos)
+            await self._queue.put(raw)
 
     async def done(self) -> None:
         if self._done_flag:
             return
         self._done_flag = True
-        self._queue.put_nowait(None)
+        await self._queue.put(None)
+
+    def _discard_requests(self) -> None:
+        # the request stream is no longer consumed; unblock writers.
+        self._done_flag = True
+        self._pending.clear()
+        while not self._queue.empty():
+            self._queue.get_nowait()
 
     async def get_result(self) -> Union[
             SpeechRecognitionResultList, SpeechRecognitionDone]:
-        if self._resp_iter is None:
-            raise Exception()
-        try:
-            resp = await self._resp_iter.__anext__()
-        except StopAsyncIteration:
-            return SpeechRecognitionDone()
+        while True:
+            if self._resp_iter is None:
+                raise Exception()
+            try:
+                resp = await self._resp_iter.__anext__()
+                break
+            except StopAsyncIteration:
+                if self._rollover_pending:
+                    await self._rollover()
+                    continue
+                self._discard_requests()
+                return SpeechRecognitionDone()
+            except Exception as e:
+                if self._replay is not None and not self._done_flag and \
+                        self._is_stream_limit(e):
+                    await self._rollover()
+                    continue
+                self._discard_requests()
+                raise
 
         ret: SpeechRecognitionResultList = []
         for srr in resp.results:
-            alternatives = [SpeechRecognitionAlternative(
-                transcript=alt.transcript, confidence=alt.confidence,
-            ) for alt in srr.alternatives]
+            alternatives = [self._alternative(alt) for alt in srr.alternatives]
+            top = alternatives[0] if alternatives else None
+            if srr.is_final and \
+                    isinstance(top, SpeechRecognitionAlternativeWords):
+                self._words_end = max(self._words_end, top.words.end[-1])
             tmp = SpeechRecognitionResult(
                 alternatives=alternatives, is_final=srr.is_final,
                 stability=srr.stability)
             ret.append(tmp)
+            if srr.is_final and self._replay is not None:
+                # result_end_time is relative to the start of the stream
+                self._replay.ack(
+                    self._pre_skip + self._granule_shift + int(
+                        srr.result_end_time.total_seconds() * 48000))
         return ret
 
+    def _alternative(self, alt: Any) -> SpeechRecognitionAlternative:
+        # word offsets are relative to the start of the current stream;
+        # words before the end of the last final (audio replayed after a
+        # rollover) were already returned.
+        origin = self._pre_skip + self._granule_shift
+        words: List[str] = []
+        start, end = array('q'), array('q')
+        for w in alt.words:
+            word_start = origin + round(w.start_time.total_seconds() * 48000)
+            if word_start < self._words_end:
+                continue
+            words.append(w.word)
+            start.append(word_start)
+            end.append(origin + round(w.end_time.total_seconds() * 48000))
+        if not words:
+            return SpeechRecognitionAlternative(
+                transcript=alt.transcript, confidence=alt.confidence)
+        return SpeechRecognitionAlternativeWords(
+            transcript=alt.transcript, confidence=alt.confidence,
+            words=WordTimings(words, start, end))
+
     async def close(self) -> None:
-        if not (self._client and hasattr(self._client, '_client')
-                and hasattr(self._client._client, '_transport')):
-            return
-        ch = self._client._client._transport.grpc_channel
-        await ch.close()
+        if self._n_requests:
+            metrics.google_coalescing_ratio.observe(self.coalescing_ratio)
+            self._n_pages = self._n_requests = 0
+        self._discard_requests()
+        if self._stream is not None:
+            self._stream.cancel()
+            self._stream = None
+        if self._client is not None:
+            client, self._client = self._client, None
+            await self.client_pool().release(client)
 
 
 class GoogleSpeechToTextV1p1beta1(GoogleSpeechToTextV1):
+    _API_MODULE = 'google.cloud.speech_v1p1beta1'
+
     def __init__(self) -> None:
-        import google.cloud.speech_v1p1beta1 as V  # type: ignore
         super().__init__()
-        self._V = V
         # self._streaming_config_keys is same as V1
         self._recognition_config_keys += [
             ('enable_word_confidence', False),
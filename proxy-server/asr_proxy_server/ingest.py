@@ -0,0 +1,160 @@
+"""Ingestion of raw PCM / mu-law audio from the client.
+
+Besides the opus packets of the WebAssembly encoder, clients (e.g.
+telephony gateways) may send raw frames selected in the initialize
+message:
+
+    {"encoding": "linear16" | "mulaw", "sample_rate": 8000, "channels": 2}
+
+Each binary message then carries any number of interleaved samples
+(16bit little endian, or 8bit G.711 mu-law). PcmIngest downmixes them to
+mono and resamples them to the rate the engine takes; for engines taking
+ogg opus, OpusFramer encodes the result into 20ms packets.
+"""
+from dataclasses import dataclass
+from math import ceil, gcd
+from typing import Any, Dict, List
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+ENCODINGS = ('opus', 'linear16', 'mulaw')
+_SAMPLE_BYTES = {'linear16': 2, 'mulaw': 1}
+
+
+def _mulaw_table() -> np.ndarray:
+    # G.711: the code is stored inverted; 0x84 is the bias of the segments
+    code = ~np.arange(256, dtype=np.uint8)
+    exponent = (code >> 4) & 7
+    mantissa = code & 0x0f
+    magnitude = ((mantissa.astype(np.int32) << 3) + 0x84) << exponent
+    return np.where(code & 0x80, 0x84 - magnitude,
+                    magnitude - 0x84).astype(np.int16)
+
+
+MULAW_TABLE = _mulaw_table()
+
+
+@dataclass
+class AudioFormat:
+    """Format of the audio sent by the client (initialize message)."""
+    encoding: str  # one of ENCODINGS
+    sample_rate: int  # of linear16 / mulaw
+    channels: int  # of linear16 / mulaw (interleaved)
+
+    @staticmethod
+    def parse(header: Dict[str, Any]) -> 'AudioFormat':
+        encoding = header.get('encoding', 'opus')
+        if encoding not in ENCODINGS:
+            raise ValueError('unsupported encoding: {}'.format(encoding))
+        ret = AudioFormat(
+            encoding=encoding,
+            sample_rate=int(header.get(
+                'sample_rate', 8000 if encoding == 'mulaw' else 16000)),
+            channels=int(header.get('channels', 1)),
+        )
+        if not 4000 <= ret.sample_rate <= 192000:
+            raise ValueError(
+                'unsupported sample rate: {}'.format(ret.sample_rate))
+        if ret.channels not in (1, 2):
+            raise ValueError('only mono/stereo audio is supported')
+        return ret
+
+
+class PolyphaseResampler(object):
+    """Streaming resampler of mono float32 audio from `fs_in` to `fs_out`.
+
+    Upsampling by L, low-pass filtering (Kaiser windowed sinc) and
+    downsampling by M (fs_out / fs_in = L / M) are done at once: output
+    sample n is the dot product of phase `n*M % L` of the filter and the
+    input samples ending at `n*M // L`, computed for all outputs of a call
+    with one einsum. The output is delayed by half the filter length.
+    """
+
+    def __init__(self, fs_in: int, fs_out: int, zero_crossings: int = 8,
+                 rolloff: float = 0.92, beta: float = 8.6) -> None:
+        g = gcd(fs_in, fs_out)
+        self._up, self._down = fs_out // g, fs_in // g
+        cutoff = min(1.0, fs_out / fs_in) * rolloff  # of the input nyquist
+        self._taps = 2 * ceil(zero_crossings / cutoff)  # per phase
+        n = self._taps * self._up
+        t = (np.arange(n) - (n - 1) / 2) / self._up  # in input samples
+        h = cutoff * np.sinc(cutoff * t) * np.kaiser(n, beta)
+        h *= self._up / h.sum()
+        # phases[p, k] multiplies the input sample k before the last one
+        self._phases = np.ascontiguousarray(
+            h.reshape(self._taps, self._up).T[:, ::-1], np.float32)
+        self._history = np.zeros(self._taps - 1, np.float32)
+        self._next = (self._taps - 1) * self._up  # n*M relative to history
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        buf = np.concatenate((self._history, x.astype(np.float32)))
+        count = max(0, (len(buf) * self._up - 1 - self._next)
+                    // self._down + 1)
+        pos = self._next + np.arange(count) * self._down
+        windows = sliding_window_view(buf, self._taps)[
+            pos // self._up - (self._taps - 1)]
+        y = np.einsum('ij,ij->i', windows, self._phases[pos % self._up])
+        drop = len(buf) - (self._taps - 1)
+        self._next += count * self._down - drop * self._up
+        self._history = buf[drop:]
+        return y
+
+
+class PcmIngest(object):
+    """Converts raw frames of `fmt` into mono int16 arrays at `fs_out`."""
+
+    def __init__(self, fmt: AudioFormat, fs_out: int) -> None:
+        self._fmt = fmt
+        self._frame_bytes = _SAMPLE_BYTES[fmt.encoding] * fmt.channels
+        self._pending = b''  # partial frame of the previous message
+        self._resampler = None if fmt.sample_rate == fs_out \
+            else PolyphaseResampler(fmt.sample_rate, fs_out)
+
+    def process(self, data: bytes) -> np.ndarray:
+        if self._pending:
+            data, self._pending = self._pending + data, b''
+        n = len(data) - len(data) % self._frame_bytes
+        if n != len(data):
+            self._pending = data[n:]
+        if self._fmt.encoding == 'mulaw':
+            x = MULAW_TABLE[np.frombuffer(data, np.uint8, n)]
+        else:
+            x = np.frombuffer(data, '<i2', n // 2)
+        if self._fmt.channels > 1:
+            x = x.reshape(-1, self._fmt.channels).mean(
+                axis=1, dtype=np.float32)
+        if self._resampler is None:
+            return x.astype(np.int16)
+        y = self._resampler.process(x)
+        return np.clip(np.rint(y), -32768, 32767).astype(np.int16)
+
+
+class OpusFramer(object):
+    """Encodes mono int16 audio at `fs` into 20ms opus packets."""
+
+    def __init__(self, fs: int) -> None:
+        from asr_proxy_server.libopus import OpusEncoder, version_string
+        self._encoder = OpusEncoder(fs, 1)
+        self._frame_size = fs // 50
+        self._pending = np.zeros(0, np.int16)
+        self.pre_skip = self._encoder.lookahead * 48000 // fs
+        self.version = 'libopus ' + version_string()
+
+    def encode(self, pcm: np.ndarray) -> List[bytes]:
+        """Encode the complete frames buffered so far."""
+        if len(self._pending):
+            pcm = np.concatenate((self._pending, pcm))
+        n = len(pcm) - len(pcm) % self._frame_size
+        self._pending = pcm[n:].copy()
+        return self._encoder.encode_many(pcm[:n], self._frame_size)
+
+    def flush(self) -> List[bytes]:
+        """Encode the last partial frame (padded with silence)."""
+        if not len(self._pending):
+            return []
+        pcm = np.zeros(self._frame_size, np.int16)
+        pcm[:len(self._pending)] = self._pending
+        self._pending = pcm[:0]
+        return self._encoder.encode_many(pcm, self._frame_size)
@@ -0,0 +1,119 @@
+"""Interim result throttling and delta coalescing."""
+import copy
+from dataclasses import dataclass
+from typing import List, Optional
+
+from asr_proxy_server.engine_base import (
+    SpeechRecognitionAlternative, SpeechRecognitionResultList)
+
+
+@dataclass
+class SpeechRecognitionAlternativeDelta(SpeechRecognitionAlternative):
+    """Alternative carrying only the changed suffix of the transcript.
+
+    The full transcript is the first `offset` characters of the previously
+    sent transcript (same result and alternative index) + `transcript`.
+    """
+    __slots__ = ('offset',)
+    offset: int
+
+    def to_json(self) -> str:
+        return super().to_json()[:-1] + ',"offset":%d}' % self.offset
+
+
+class InterimThrottle(object):
+    """Per-session policy for sending interim results.
+
+    * interim results are sent at most once per `min_interval` seconds;
+      an interim waiting for its turn is replaced by newer ones
+    * with `delta`, only the changed suffix of each transcript is sent and
+      interims whose transcripts did not change at all are dropped
+    * responses containing a final result are always sent immediately and
+      discard the waiting interim
+    """
+
+    def __init__(self, *, min_interval: float = 0.0,
+                 delta: bool = False) -> None:
+        self._min_interval = min_interval
+        self._delta = delta
+        self._last_sent = float('-inf')
+        self._pending: Optional[SpeechRecognitionResultList] = None
+        self._prev_transcripts: List[List[str]] = []
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """Time at which the waiting interim result can be sent."""
+        if self._pending is None:
+            return None
+        return self._last_sent + self._min_interval
+
+    def push(self, results: SpeechRecognitionResultList,
+             now: float) -> List[SpeechRecognitionResultList]:
+        """Return the responses to be sent now."""
+        if any(r.is_final for r in results):
+            self._pending = None
+            self._prev_transcripts = []
+            return [results]
+        self._pending = results
+        return self.poll(now)
+
+    def poll(self, now: float) -> List[SpeechRecognitionResultList]:
+        deadline = self.deadline
+        if deadline is None or now < deadline:
+            return []
+        return self.flush(now)
+
+    def flush(self, now: float) -> List[SpeechRecognitionResultList]:
+        """Send the waiting interim result regardless of the interval."""
+        results, self._pending = self._pending, None
+        if results is None:
+            return []
+        if self._delta:
+            results = self._to_delta(results)
+            if not results:
+                return []
+        self._last_sent = now
+        return [results]
+
+    def _to_delta(
+            self, results: SpeechRecognitionResultList
+    ) -> SpeechRecognitionResultList:
+        prev, changed = self._prev_transcripts, False
+        ret: SpeechRecognitionResultList = []
+        transcripts: List[List[str]] = []
+        for i, result in enumerate(results):
+            prev_alts = prev[i] if i < len(prev) else []
+            if len(prev_alts) != len(result.alternatives):
+                changed = True
+            alternatives: List[SpeechRecognitionAlternative] = []
+            for j, alt in enumerate(result.alternatives):
+                base = prev_alts[j] if j < len(prev_alts) else ''
+                offset = _common_prefix_length(base, alt.transcript)
+                if offset != len(base) or offset != len(alt.transcript):
+                    changed = True
+                alternatives.append(SpeechRecognitionAlternativeDelta(
+                    transcript=alt.transcript[offset:],
+                    confidence=alt.confidence, offset=offset))
+            result = copy.copy(result)
+            transcripts.append([
+                alt.transcript for alt in result.alternatives])
+            result.alternatives = alternatives
+            ret.append(result)
+        if not changed and len(results) == len(prev):
+            return []
+        self._prev_transcripts = transcripts
+        return ret
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    lo, hi = 0, n  # a[:lo] == b[:lo] and a[:hi] != b[:hi]
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
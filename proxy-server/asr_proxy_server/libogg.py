@@ -1,12 +1,13 @@
 """libogg python wrapper."""
-import array
 from ctypes import (
-    CDLL, POINTER, Structure, c_int, c_int64, c_long, c_uint8, cast)
-from ctypes.util import find_library
+    POINTER, Structure, addressof, c_char, c_int, c_int64, c_long, c_uint8,
+    cast, memmove)
 import math
-from typing import Optional
+from typing import Optional, Union
 
-libogg = CDLL(find_library('ogg'))
+from asr_proxy_server.native import load_library
+
+libogg = load_library('ogg')
 
 c_uint8_p = POINTER(c_uint8)
 c_int64_p = POINTER(c_int64)
@@ -77,28 +78,38 @@ class Ogg(object):
         self._packetno = 0
         self._state = ogg_stream_state()
         self._packet = ogg_packet()
-        self._packet_buf = array.array('B', [0] * (2**14))
         self._page = ogg_page()
         self._cache = bytearray(2**16)
+        self._cache_addr = addressof(c_char.from_buffer(self._cache))
         if libogg.ogg_stream_init(self._state, serialno) != 0:
             raise RuntimeError('ogg_stream_init failed')
-        self._packet.packet = cast(
-            self._packet_buf.buffer_info()[0], c_uint8_p)  # type: ignore
 
     def __del__(self) -> None:
         libogg.ogg_stream_clear(self._state)
 
-    def packetin(self, packet: bytes, granulepos: int,
+    def packetin(self, packet: Union[bytes, bytearray, memoryview],
+                 granulepos: int,
                  *, b_o_s: bool = False, e_o_s: bool = False) -> None:
-        for i, b in enumerate(packet):
-            self._packet_buf[i] = b
+        # ogg_stream_packetin copies the packet body into the stream state,
+        # so ogg_packet.packet only has to point at the caller's buffer
+        # for the duration of the call.
+        if isinstance(packet, memoryview) and packet.readonly:
+            packet = packet.tobytes()
+        if isinstance(packet, bytes):
+            self._packet.packet = cast(packet, c_uint8_p)  # type: ignore
+        elif len(packet) > 0:
+            self._packet.packet = cast(
+                (c_uint8 * len(packet)).from_buffer(packet),
+                c_uint8_p)  # type: ignore
         self._packet.bytes = len(packet)
         self._packet.b_o_s = 1 if b_o_s else 0
         self._packet.e_o_s = 1 if e_o_s else 0
         self._packet.granulepos = granulepos
         self._packet.packetno = self._packetno
         self._packetno += 1
-        if libogg.ogg_stream_packetin(self._state, self._packet) != 0:
+        ret = libogg.ogg_stream_packetin(self._state, self._packet)
+        self._packet.packet = None
+        if ret != 0:
             raise RuntimeError('ogg_stream_packetin failed')
 
     def pageout(self) -> Optional[bytes]:
@@ -112,11 +123,11 @@ class Ogg(object):
         return self._copy_page()
 
     def _copy_page(self) -> bytes:
-        total_len = self._page.header_len + self._page.body_len
+        header_len, body_len = self._page.header_len, self._page.body_len
+        total_len = header_len + body_len
         if len(self._cache) < total_len:
             self._cache = bytearray(2**math.ceil(math.log2(total_len)))
-        for i in range(self._page.header_len):
-            self._cache[i] = self._page.header[i]
-        for i in range(self._page.body_len):
-            self._cache[self._page.header_len + i] = self._page.body[i]
-        return memoryview(self._cache)[0:total_len].tobytes()
+            self._cache_addr = addressof(c_char.from_buffer(self._cache))
+        memmove(self._cache_addr, self._page.header, header_len)
+        memmove(self._cache_addr + header_len, self._page.body, body_len)
+        return bytes(memoryview(self._cache)[0:total_len])
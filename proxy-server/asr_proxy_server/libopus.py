@@ -1,14 +1,24 @@
 """libopus python wrapper."""
 import array
 from ctypes import (
-    CDLL, POINTER, c_int, c_int16, c_int32, c_uint8, c_void_p, cast)
-from ctypes.util import find_library
-from typing import Sequence
+    POINTER, byref, c_char_p, c_int, c_int16, c_int32, c_uint8, c_void_p, cast)
+from typing import Any, List, Optional, Sequence, Union
 
-libopus = CDLL(find_library('opus'))
+import numpy as np
+
+from asr_proxy_server.native import load_library
+
+libopus = load_library('opus')
 
 c_uint8_p = POINTER(c_uint8)
 c_int16_p = POINTER(c_int16)
+c_int_p = POINTER(c_int)
+
+_Buffer = Union[bytes, bytearray, memoryview]
+
+OPUS_INVALID_PACKET = -4
+OPUS_APPLICATION_VOIP = 2048
+OPUS_GET_LOOKAHEAD_REQUEST = 4027
 
 libopus.opus_decoder_get_size.restype = c_int
 libopus.opus_decoder_get_size.argtypes = [c_int]
@@ -16,16 +26,64 @@ libopus.opus_decoder_init.restype = c_int
 libopus.opus_decoder_init.argtypes = [c_void_p, c_int32, c_int]
 libopus.opus_decode.restype = c_int
 libopus.opus_decode.argtypes = [
-    c_void_p, c_uint8_p, c_int, c_int16_p, c_int, c_int]
+    c_void_p, c_void_p, c_int32, c_void_p, c_int, c_int]
+libopus.opus_decode_float.restype = c_int
+libopus.opus_decode_float.argtypes = [
+    c_void_p, c_void_p, c_int32, c_void_p, c_int, c_int]
+libopus.opus_encoder_get_size.restype = c_int
+libopus.opus_encoder_get_size.argtypes = [c_int]
+libopus.opus_encoder_init.restype = c_int
+libopus.opus_encoder_init.argtypes = [c_void_p, c_int32, c_int, c_int]
+libopus.opus_encode.restype = c_int32
+libopus.opus_encode.argtypes = [
+    c_void_p, c_int16_p, c_int, c_uint8_p, c_int32]
+libopus.opus_get_version_string.restype = c_char_p
+libopus.opus_packet_get_nb_samples.restype = c_int
+libopus.opus_packet_get_nb_samples.argtypes = [c_void_p, c_int32, c_int32]
+libopus.opus_packet_parse.restype = c_int
+libopus.opus_packet_parse.argtypes = [
+    c_void_p, c_int32, c_uint8_p, c_void_p, c_int16_p, c_int_p]
+
+
+def packet_get_nb_samples(packet: _Buffer, fs: int = 48000) -> int:
+    """Returns the number of samples of `packet` or a negative error code.
+
+    The framing is validated by `opus_packet_parse` first, since
+    `opus_packet_get_nb_samples` only looks at the first two bytes.
+    """
+    if not len(packet):
+        return OPUS_INVALID_PACKET
+    # passed like the packets of `OpusDecoder._decode`
+    data = np.frombuffer(packet, np.uint8)
+    toc = c_uint8()
+    sizes = (c_int16 * 48)()
+    payload_offset = c_int()
+    ret = libopus.opus_packet_parse(
+        data.ctypes.data, len(data), byref(toc), None, sizes,
+        byref(payload_offset))
+    if ret < 0:
+        return ret
+    return libopus.opus_packet_get_nb_samples(
+        data.ctypes.data, len(data), fs)
 
 
 class OpusDecoder(object):
+    """Decodes opus packets into numpy arrays.
+
+    Samples are interleaved (`ch` per frame) int16 or float32 values at
+    `fs`. Without `out`, the samples are written to a buffer owned by the
+    decoder and the returned array is only valid until the next call;
+    with `out`, they are written to the start of `out` (which must be
+    C-contiguous and large enough) and a view of the written part is
+    returned.
+    """
+
     def __init__(self, fs: int, ch: int) -> None:
         self._fs, self._ch = fs, ch
         self._max_frame_size = int(fs * 0.120)
-        self._pcm = array.array('h', [0] * (self._max_frame_size * ch))
-        self._pcm_ref = cast(
-            self._pcm.buffer_info()[0], c_int16_p)  # type: ignore
+        self._buffers = {
+            np.dtype(t): np.zeros(self._max_frame_size * ch, t)
+            for t in (np.int16, np.float32)}
         self._handle_obj = array.array(
             'B', [0] * libopus.opus_decoder_get_size(ch))
         self._handle = cast(
@@ -34,9 +92,134 @@ class OpusDecoder(object):
         if err != 0:
             raise RuntimeError('Failed: decoder_create({})'.format(err))
 
-    def decode(self, packet: bytes) -> Sequence[float]:
-        packet_ptr = cast(packet, c_uint8_p)  # type: ignore
-        samples = libopus.opus_decode(
-            self._handle, packet_ptr, len(packet), self._pcm_ref,
-            self._max_frame_size, 0)
-        return self._pcm[0:samples]
+    def _decode(self, packet: Optional[_Buffer], frame_size: int,
+                out: Optional[np.ndarray], dtype: Any, fec: int) -> np.ndarray:
+        if out is None:
+            out = self._buffers[np.dtype(dtype)]
+        elif not out.flags.c_contiguous:
+            raise ValueError('out must be C-contiguous')
+        frame_size = min(frame_size, len(out) // self._ch)
+        if out.dtype == np.int16:
+            func = libopus.opus_decode
+        elif out.dtype == np.float32:
+            func = libopus.opus_decode_float
+        else:
+            raise TypeError('unsupported dtype: {}'.format(out.dtype))
+        if packet is None or len(packet) == 0:
+            data, n = None, 0
+        else:
+            # a read-only view works for bytes / memoryview / mmap alike;
+            # libopus never writes to the packet
+            data = np.frombuffer(packet, np.uint8)
+            n = len(data)
+        ret = func(self._handle, None if data is None else data.ctypes.data,
+                   n, out.ctypes.data, frame_size, fec)
+        if ret < 0:
+            raise RuntimeError('Failed: opus_decode({})'.format(ret))
+        return out[:ret * self._ch]
+
+    def decode(self, packet: _Buffer, out: Optional[np.ndarray] = None,
+               dtype: Any = np.int16) -> np.ndarray:
+        """Decode one packet (`dtype` is used only without `out`)."""
+        return self._decode(packet, self._max_frame_size, out, dtype, 0)
+
+    def decode_many(self, packets: Sequence[_Buffer],
+                    out: Optional[np.ndarray] = None,
+                    dtype: Any = np.int16) -> np.ndarray:
+        """Decode `packets` back to back into one array.
+
+        Without `out`, a new array just large enough is allocated.
+        """
+        if out is None:
+            n = 0
+            for packet in packets:
+                size = packet_get_nb_samples(packet, self._fs)
+                if size < 0:
+                    raise RuntimeError(
+                        'Failed: opus_packet_parse({})'.format(size))
+                n += size
+            out = np.empty(n * self._ch, dtype)
+        pos = 0
+        for packet in packets:
+            pos += len(self._decode(
+                packet, self._max_frame_size, out[pos:], None, 0))
+        return out[:pos]
+
+    def decode_gap(self, n_samples: int, next_packet: Optional[_Buffer] = None,
+                   out: Optional[np.ndarray] = None,
+                   dtype: Any = np.int16) -> np.ndarray:
+        """Fill a gap of `n_samples` (at `fs`) of lost packets.
+
+        With the packet following the gap, its in-band FEC data (if any)
+        recovers the end of the gap, and packet loss concealment fills the
+        rest; `next_packet` itself must be decoded afterwards as usual.
+        Gaps are filled in multiples of 2.5ms, the rest is dropped.
+        """
+        unit = self._fs // 400
+        n_samples -= n_samples % unit
+        if out is None:
+            out = self._buffers[np.dtype(dtype)]
+            if n_samples > self._max_frame_size:
+                out = np.empty(n_samples * self._ch, dtype)
+        pos = 0
+        while pos < n_samples:
+            # at most 120ms per call; FEC only applies to the end of the gap
+            n = min(n_samples - pos, self._max_frame_size)
+            fec = pos + n == n_samples and next_packet is not None
+            pos += len(self._decode(
+                next_packet if fec else None, n, out[pos * self._ch:],
+                None, int(fec))) // self._ch
+        return out[:pos * self._ch]
+
+
+def version_string() -> str:
+    return libopus.opus_get_version_string().decode('ascii')
+
+
+class OpusEncoder(object):
+    def __init__(self, fs: int, ch: int,
+                 application: int = OPUS_APPLICATION_VOIP) -> None:
+        self._fs, self._ch = fs, ch
+        self._data = (c_uint8 * 1275)()
+        self._handle_obj = array.array(
+            'B', [0] * libopus.opus_encoder_get_size(ch))
+        self._handle = cast(
+            self._handle_obj.buffer_info()[0], c_void_p)  # type: ignore
+        err = libopus.opus_encoder_init(self._handle, fs, ch, application)
+        if err != 0:
+            raise RuntimeError('Failed: encoder_create({})'.format(err))
+
+    @property
+    def lookahead(self) -> int:
+        """Encoder delay in samples at `fs`."""
+        ret = c_int32()
+        libopus.opus_encoder_ctl(
+            self._handle, OPUS_GET_LOOKAHEAD_REQUEST, byref(ret))
+        return ret.value
+
+    def encode(self, pcm: Union[bytes, memoryview]) -> bytes:
+        """Encode one frame of interleaved 16bit little endian samples."""
+        frame_size = len(pcm) // (2 * self._ch)
+        pcm_obj = (c_int16 * (frame_size * self._ch)).from_buffer_copy(pcm)
+        n = libopus.opus_encode(
+            self._handle, pcm_obj, frame_size, self._data, len(self._data))
+        if n < 0:
+            raise RuntimeError('Failed: opus_encode({})'.format(n))
+        return memoryview(self._data)[:n].tobytes()
+
+    def encode_many(self, pcm: np.ndarray, frame_size: int) -> List[bytes]:
+        """Encode consecutive frames of `frame_size` samples per channel of
+        an interleaved int16 array (a partial last frame is ignored)."""
+        pcm = np.ascontiguousarray(pcm, np.int16)
+        step = frame_size * self._ch
+        base = pcm.ctypes.data
+        ret = []
+        with memoryview(self._data) as data:
+            for pos in range(0, len(pcm) - step + 1, step):
+                n = libopus.opus_encode(
+                    self._handle, cast(base + pos * 2, c_int16_p),
+                    frame_size, self._data, len(self._data))
+                if n < 0:
+                    raise RuntimeError('Failed: opus_encode({})'.format(n))
+                ret.append(data[:n].tobytes())
+        return ret
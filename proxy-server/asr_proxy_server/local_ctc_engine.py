@@ -0,0 +1,309 @@
+"""Local CTC speech recognition with cross-session batching.
+
+Audio of every session is cut into fixed-size chunks; chunks of all
+sessions of the process are batched by one BatchScheduler into a single
+model call (up to `max_batch_size` chunks, waiting at most `max_wait`
+seconds for a batch to fill) and decoded greedily.
+
+The model is an ONNX CTC model (`ASR_LOCAL_CTC_MODEL`, with the token
+list in `ASR_LOCAL_CTC_VOCAB`) or, by default, TinyCtcModel.
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from asyncio import Future, Queue
+import math
+import os
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from asr_proxy_server.engine_base import (
+    PcmEngine, SpeechRecognitionAlternative, SpeechRecognitionConfig,
+    SpeechRecognitionDone, SpeechRecognitionError, SpeechRecognitionResult,
+    SpeechRecognitionResultList)
+
+
+class CtcModel(ABC):
+    """Acoustic model interface: float32 audio [B, N] -> logits [B, T, V].
+
+    Index 0 of the vocabulary is the CTC blank.
+    """
+    sample_rate = 16000
+    vocabulary: Sequence[str] = ()
+
+    @abstractmethod
+    def n_frames(self, n_samples: int) -> int:
+        """Number of output frames covering `n_samples` input samples."""
+        pass
+
+    @abstractmethod
+    def __call__(self, audio: np.ndarray) -> np.ndarray:
+        pass
+
+
+class TinyCtcModel(CtcModel):
+    """A tiny randomly initialized model (log filterbank + RNN + linear).
+
+    Its transcripts are meaningless; it has the cost profile of a real
+    (small) model and is used for tests and benchmarks.
+    """
+    vocabulary = ['', ' '] + [chr(c) for c in range(ord('a'), ord('z') + 1)]
+    win_length, hop_length, n_fft, n_mels, n_hidden = 400, 160, 512, 80, 512
+
+    def __init__(self, seed: int = 0) -> None:
+        rng = np.random.RandomState(seed)
+        self._window = np.hanning(self.win_length).astype(np.float32)
+        # triangular filters evenly spaced on the mel scale
+        mel = np.linspace(0, 2595 * np.log10(1 + 8000 / 700), self.n_mels + 2)
+        bins = np.floor((self.n_fft + 1) * 700 * (10 ** (mel / 2595) - 1)
+                        / self.sample_rate).astype(int)
+        fbank = np.zeros((self.n_fft // 2 + 1, self.n_mels), np.float32)
+        for i in range(self.n_mels):
+            lo, mid, hi = bins[i], bins[i + 1], bins[i + 2]
+            fbank[lo:mid, i] = np.linspace(0, 1, mid - lo, endpoint=False)
+            fbank[mid:hi, i] = np.linspace(1, 0, hi - mid, endpoint=False)
+        self._fbank = fbank
+        self._w1 = (rng.randn(self.n_mels, self.n_hidden) / 8).astype(
+            np.float32)
+        self._u1 = (rng.randn(self.n_hidden, self.n_hidden) / 16).astype(
+            np.float32)
+        self._w2 = (rng.randn(self.n_hidden, len(self.vocabulary)) / 4
+                    ).astype(np.float32)
+        self._b2 = np.zeros(len(self.vocabulary), np.float32)
+        self._b2[0] = 2.0  # mostly blank, like a trained CTC model
+
+    def n_frames(self, n_samples: int) -> int:
+        if n_samples < self.win_length:
+            return 0
+        return 1 + (n_samples - self.win_length) // self.hop_length
+
+    def __call__(self, audio: np.ndarray) -> np.ndarray:
+        batch, n = audio.shape
+        n_frames = self.n_frames(n)
+        frames = np.lib.stride_tricks.as_strided(
+            audio, (batch, n_frames, self.win_length),
+            (audio.strides[0], audio.strides[1] * self.hop_length,
+             audio.strides[1]), writeable=False)
+        spec = np.fft.rfft(frames * self._window, self.n_fft)
+        power = (spec.real ** 2 + spec.imag ** 2).astype(np.float32)
+        feats = np.log(power @ self._fbank + 1e-6)
+        feats -= feats.mean(axis=1, keepdims=True)
+        x = feats @ self._w1
+        h = np.zeros((batch, self.n_hidden), np.float32)
+        for t in range(n_frames):  # frame by frame, like a streaming model
+            h = x[:, t] = np.tanh(x[:, t] + h @ self._u1)
+        return x @ self._w2 + self._b2
+
+
+class OnnxCtcModel(CtcModel):
+    """CTC model exported to ONNX (waveform input, logits output)."""
+
+    def __init__(self, path: str, vocabulary: Sequence[str],
+                 hop_length: int = 320) -> None:
+        import onnxruntime  # type: ignore
+        self._session = onnxruntime.InferenceSession(path)
+        self._input_name = self._session.get_inputs()[0].name
+        self.vocabulary = list(vocabulary)
+        self.hop_length = hop_length
+
+    def n_frames(self, n_samples: int) -> int:
+        return math.ceil(n_samples / self.hop_length)
+
+    def __call__(self, audio: np.ndarray) -> np.ndarray:
+        return self._session.run(None, {self._input_name: audio})[0]
+
+
+def load_model() -> CtcModel:
+    path = os.environ.get('ASR_LOCAL_CTC_MODEL')
+    if not path:
+        return TinyCtcModel()
+    with open(os.environ['ASR_LOCAL_CTC_VOCAB'], encoding='utf8') as f:
+        vocabulary = [line.rstrip('\n') for line in f]
+    return OnnxCtcModel(path, vocabulary, hop_length=int(
+        os.environ.get('ASR_LOCAL_CTC_HOP', 320)))
+
+
+class BatchScheduler(object):
+    """Runs chunks of many sessions through `model` in batches.
+
+    A batch is started when `max_batch_size` chunks are waiting or the
+    oldest waiting chunk has waited `max_wait` seconds. One batch runs at a
+    time (in the default executor, numpy releases the GIL), so chunks
+    arriving meanwhile form the next batch.
+    """
+
+    def __init__(self, model: CtcModel, *, max_batch_size: int = 32,
+                 max_wait: float = 0.01) -> None:
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._waiting: List[Tuple[np.ndarray, Future, float]] = []
+        self._event: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.n_batches = 0
+        self.n_chunks = 0
+
+    async def infer(self, audio: np.ndarray) -> np.ndarray:
+        """Returns the logits [T, V] of one chunk of float32 audio."""
+        loop = asyncio.get_event_loop()
+        if self._task is None:
+            self._event = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        fut = loop.create_future()
+        self._waiting.append((audio, fut, loop.time()))
+        self._event.set()  # type: ignore
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        event = self._event
+        assert event is not None
+        while True:
+            while not self._waiting:
+                event.clear()
+                await event.wait()
+            deadline = self._waiting[0][2] + self.max_wait
+            while len(self._waiting) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = self._waiting[:self.max_batch_size]
+            del self._waiting[:self.max_batch_size]
+            batch = [b for b in batch if not b[1].cancelled()]
+            if not batch:
+                continue
+            try:
+                logits = await loop.run_in_executor(
+                    None, self.model, np.stack([b[0] for b in batch]))
+            except Exception as e:
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_chunks += len(batch)
+            for i, (_, fut, _) in enumerate(batch):
+                if not fut.done():
+                    fut.set_result(logits[i])
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class LocalCtcEngine(PcmEngine):
+    """Greedy CTC decoding of fixed-size chunks with a shared scheduler.
+
+    An interim result is returned after every chunk whose transcript
+    changed (with `interim_results`), and a final result at the end.
+    """
+    sample_rate = 16000
+    _scheduler: Optional[BatchScheduler] = None
+
+    @classmethod
+    def scheduler(cls) -> BatchScheduler:
+        if cls._scheduler is None:
+            cls.use_scheduler(BatchScheduler(
+                load_model(),
+                max_batch_size=int(os.environ.get(
+                    'ASR_LOCAL_CTC_MAX_BATCH', 32)),
+                max_wait=float(os.environ.get(
+                    'ASR_LOCAL_CTC_MAX_WAIT_MS', 10)) / 1000))
+        return cls._scheduler  # type: ignore
+
+    @classmethod
+    def use_scheduler(cls, scheduler: BatchScheduler) -> None:
+        cls._scheduler = scheduler
+
+    @classmethod
+    async def startup(cls) -> None:
+        cls.scheduler()  # load the model before the first session
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        if cls._scheduler is not None:
+            await cls._scheduler.close()
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunk = np.zeros(0, np.float32)
+        self._fill = 0
+        self._interim_results = False
+        self._tokens: List[int] = []
+        self._last_token = 0
+        self._log_prob_sum = 0.0
+        self._n_frames = 0
+        self._queue: Queue[Union[
+            SpeechRecognitionResultList, SpeechRecognitionDone,
+            SpeechRecognitionError]] = Queue()
+
+    async def init(self, config: SpeechRecognitionConfig) -> None:
+        self._interim_results = config.interim_results
+        chunk_ms = int(os.environ.get('ASR_LOCAL_CTC_CHUNK_MS', 1000))
+        self._chunk = np.zeros(self.sample_rate * chunk_ms // 1000,
+                               np.float32)
+
+    async def write_pcm(self, pcm: np.ndarray) -> None:
+        pos = 0
+        while pos < len(pcm):
+            n = min(len(pcm) - pos, len(self._chunk) - self._fill)
+            self._chunk[self._fill:self._fill + n] = pcm[pos:pos + n]
+            self._chunk[self._fill:self._fill + n] *= 1 / 32768
+            self._fill += n
+            pos += n
+            if self._fill == len(self._chunk):
+                await self._infer_chunk()
+
+    async def _infer_chunk(self) -> None:
+        scheduler = self.scheduler()
+        n_frames = scheduler.model.n_frames(self._fill)
+        self._chunk[self._fill:] = 0
+        logits = await scheduler.infer(self._chunk.copy())
+        self._fill = 0
+        n_tokens = len(self._tokens)
+        self._decode(logits[:n_frames])
+        if self._interim_results and len(self._tokens) != n_tokens:
+            self._queue.put_nowait([self._result(False)])
+
+    def _decode(self, logits: np.ndarray) -> None:
+        if not len(logits):
+            return
+        # log softmax of the best token of each frame
+        m = logits.max(axis=1)
+        log_z = m + np.log(np.exp(logits - m[:, None]).sum(axis=1))
+        self._log_prob_sum += float((m - log_z).sum())
+        self._n_frames += len(logits)
+        for token in logits.argmax(axis=1).tolist():
+            if token != self._last_token and token != 0:
+                self._tokens.append(token)
+            self._last_token = token
+
+    def _result(self, is_final: bool) -> SpeechRecognitionResult:
+        vocabulary = self.scheduler().model.vocabulary
+        confidence = math.exp(self._log_prob_sum / max(1, self._n_frames))
+        return SpeechRecognitionResult(
+            is_final=is_final, alternatives=[SpeechRecognitionAlternative(
+                transcript=''.join([vocabulary[t] for t in self._tokens]),
+                confidence=confidence)])
+
+    async def done(self) -> None:
+        if self._fill:
+            await self._infer_chunk()
+        self._queue.put_nowait([self._result(True)])
+        self._queue.put_nowait(SpeechRecognitionDone())
+
+    async def get_result(self) -> Union[
+            SpeechRecognitionResultList, SpeechRecognitionDone]:
+        ret = await self._queue.get()
+        if isinstance(ret, SpeechRecognitionError):
+            raise ret
+        return ret
+
+    async def close(self) -> None:
+        pass
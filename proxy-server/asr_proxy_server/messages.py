@@ -0,0 +1,36 @@
+"""Server to client message encoding."""
+import json
+from typing import Any, Optional, Union
+
+from asr_proxy_server.engine_base import (
+    SpeechRecognitionDone, SpeechRecognitionError, SpeechRecognitionResultList)
+
+
+def json_dumps(o: Any) -> str:
+    return json.dumps(
+        o, ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+
+def encode_response(
+        resp: Union[SpeechRecognitionResultList, SpeechRecognitionDone,
+                    SpeechRecognitionError],
+        session: Optional[int] = None) -> str:
+    """Encode `resp` as a result, done or error message.
+
+    When `session` is given the message is tagged with the session id
+    (multiplexed protocol); result lists are then wrapped in an object.
+    """
+    if isinstance(resp, (SpeechRecognitionDone, SpeechRecognitionError)):
+        obj = resp.to_dict()
+        if session is not None:
+            obj['session'] = session
+        return json_dumps(obj)
+    results = encode_results(resp)
+    if session is None:
+        return results
+    return '{"type":"result","session":%d,"results":%s}' % (
+        session, results)
+
+
+def encode_results(results: SpeechRecognitionResultList) -> str:
+    return '[' + ','.join([r.to_json() for r in results]) + ']'
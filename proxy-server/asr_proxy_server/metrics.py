@@ -0,0 +1,242 @@
+"""Process-wide metrics in the Prometheus text exposition format.
+
+Metrics are plain Python objects updated in the event loop thread (no
+locks), so recording a value costs a dict lookup and an addition.
+
+When several worker processes serve the same port (see supervisor.py), each
+worker writes a snapshot of its metrics to a shared directory and
+`/metrics` renders the sum over all snapshots.
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+import glob
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+_REGISTRY: List['_Metric'] = []
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class _Metric(ABC):
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _REGISTRY.append(self)
+
+    def _format_labels(self, values: LabelValues,
+                       extra: str = '') -> str:
+        pairs = ['{}="{}"'.format(k, _escape(v))
+                 for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    @abstractmethod
+    def samples(self, values: Dict[LabelValues, Any]) -> List[str]:
+        pass
+
+    @abstractmethod
+    def merge(self, into: Dict[LabelValues, Any],
+              values: Dict[LabelValues, Any]) -> None:
+        pass
+
+    def render(self, values: Optional[Dict[LabelValues, Any]] = None) -> str:
+        return '\n'.join([
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type_name),
+        ] + self.samples(self.values if values is None else values))
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self, values: Dict[LabelValues, float]) -> List[str]:
+        return ['{}{} {}'.format(self.name, self._format_labels(k), v)
+                for k, v in values.items()]
+
+    def merge(self, into: Dict[LabelValues, float],
+              values: Dict[LabelValues, float]) -> None:
+        for k, v in values.items():
+            into[k] = into.get(k, 0) + v
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [count of each bucket (non-cumulative)..., sum]
+        self.values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        v = self.values.get(labels)
+        if v is None:
+            v = self.values[labels] = [0] * (len(self.buckets) + 2)
+        v[bisect_left(self.buckets, value)] += 1
+        v[-1] += value
+
+    def samples(self, values: Dict[LabelValues, List[float]]) -> List[str]:
+        ret = []
+        for k, v in values.items():
+            cumulative = 0
+            for le, n in zip(self.buckets + (float('inf'),), v):
+                cumulative += n
+                ret.append('{}_bucket{} {}'.format(
+                    self.name, self._format_labels(k, 'le="{}"'.format(
+                        '+Inf' if le == float('inf') else le)), cumulative))
+            ret.append('{}_sum{} {}'.format(
+                self.name, self._format_labels(k), v[-1]))
+            ret.append('{}_count{} {}'.format(
+                self.name, self._format_labels(k), cumulative))
+        return ret
+
+    def merge(self, into: Dict[LabelValues, List[float]],
+              values: Dict[LabelValues, List[float]]) -> None:
+        for k, v in values.items():
+            acc = into.get(k)
+            if acc is None:
+                into[k] = list(v)
+            else:
+                for i, x in enumerate(v):
+                    acc[i] += x
+
+
+def _escape(v: str) -> str:
+    return v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render(snapshots: Optional[Sequence[Dict[str, Any]]] = None) -> str:
+    """Render this process' metrics, or the sum of `snapshots`."""
+    if snapshots is None:
+        return '\n'.join([m.render() for m in _REGISTRY]) + '\n'
+    ret = []
+    for m in _REGISTRY:
+        values: Dict[LabelValues, Any] = {}
+        for snapshot in snapshots:
+            m.merge(values, {
+                tuple(k): v for k, v in snapshot.get(m.name, [])})
+        ret.append(m.render(values))
+    return '\n'.join(ret) + '\n'
+
+
+def snapshot() -> Dict[str, Any]:
+    return {m.name: [[list(k), v] for k, v in m.values.items()]
+            for m in _REGISTRY}
+
+
+def _snapshot_path(directory: str, pid: int) -> str:
+    return os.path.join(directory, 'worker-{}.json'.format(pid))
+
+
+def write_snapshot(directory: str) -> None:
+    path = _snapshot_path(directory, os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def read_snapshots(directory: str) -> List[Dict[str, Any]]:
+    ret = []
+    for path in glob.glob(os.path.join(directory, 'worker-*.json')):
+        try:
+            with open(path) as f:
+                ret.append(json.load(f))
+        except (OSError, ValueError):
+            pass  # removed or being replaced
+    return ret
+
+
+def remove_snapshot(directory: str, pid: int) -> None:
+    """Remove the snapshot of worker `pid` (which has exited)."""
+    for path in (_snapshot_path(directory, pid),
+                 _snapshot_path(directory, pid) + '.tmp'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def clear_snapshots(directory: str) -> None:
+    """Remove the snapshots left by the workers of a previous run."""
+    for path in glob.glob(os.path.join(directory, 'worker-*.json*')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+sessions = Counter(
+    'asr_sessions_total', 'Recognition sessions started', ['engine'])
+active_sessions = Gauge(
+    'asr_active_sessions', 'Recognition sessions in progress')
+errors = Counter(
+    'asr_errors_total', 'Sessions ended with an error', ['code'])
+received_bytes = Counter(
+    'asr_received_bytes_total', 'Opus packet bytes received from clients')
+malformed_packets = Counter(
+    'asr_malformed_packets_total', 'Malformed opus packets dropped')
+upstream_bytes = Counter(
+    'asr_upstream_bytes_total', 'Ogg page bytes written to engines')
+sent_chars = Counter(
+    'asr_sent_characters_total',
+    'Message characters (not UTF-8 bytes) sent to clients')
+receive_to_page = Histogram(
+    'asr_receive_to_page_seconds',
+    'Time from receiving an opus packet to writing its ogg page')
+page_write = Histogram(
+    'asr_page_write_seconds', 'Time spent in Engine.write_ogg_opus_page')
+engine_queue_depth = Histogram(
+    'asr_engine_queue_depth', 'Engine queue depth sampled on page writes',
+    buckets=DEPTH_BUCKETS)
+google_coalescing_ratio = Histogram(
+    'asr_google_coalescing_ratio',
+    'Average ogg pages per StreamingRecognizeRequest of a session',
+    buckets=(1, 1.5, 2, 4, 8, 16, 32, 64))
+time_to_first_interim = Histogram(
+    'asr_time_to_first_interim_seconds',
+    'Time from the first page write to the first interim result')
+time_to_final = Histogram(
+    'asr_time_to_final_seconds',
+    'Time from the end of audio to the final result')
+vad_dropped_seconds = Counter(
+    'asr_vad_dropped_seconds_total', 'Audio seconds dropped by server VAD')
+result_cache_requests = Counter(
+    'asr_result_cache_requests_total', 'Result cache lookups', ['result'])
+admission_rejected = Counter(
+    'asr_admission_rejected_total', 'Sessions rejected by admission control',
+    ['engine', 'reason'])
+admission_wait = Histogram(
+    'asr_admission_wait_seconds', 'Time admitted sessions waited to start',
+    ['engine'])
@@ -0,0 +1,176 @@
+"""Multiplexed WebSocket protocol (many sessions per connection)."""
+import asyncio
+from asyncio import Queue, QueueFull, Task
+from collections import deque
+import json
+import logging
+import random
+import struct
+from typing import Any, Deque, Dict, Tuple
+
+from fastapi import WebSocket
+
+from asr_proxy_server import metrics
+from asr_proxy_server.asr_endpoint import asr_endpoint
+from asr_proxy_server.engine_base import (
+    SpeechRecognitionError, SpeechRecognitionErrorCode)
+from asr_proxy_server.interim_throttle import SpeechRecognitionAlternativeDelta
+from asr_proxy_server.messages import encode_response
+
+SESSION_ID = struct.Struct('>H')
+MAX_SESSIONS = 256
+MAX_QUEUED_PACKETS = 256
+MAX_QUEUED_MESSAGES = 32  # per session, see FairSender
+
+logger = logging.getLogger(__name__)
+
+
+class FairSender(object):
+    """Sends queued messages of several sessions round-robin.
+
+    A session with many pending messages (e.g. a burst of interim results)
+    cannot delay the messages of the other sessions by more than one
+    message each. Once `max_queued` messages of a session are pending (the
+    socket is slow), a `replaceable` message (an interim result) replaces
+    the pending replaceable ones of the session instead of being queued
+    after them.
+    """
+
+    def __init__(self, ws: WebSocket,
+                 max_queued: int = MAX_QUEUED_MESSAGES) -> None:
+        self._ws = ws
+        self._max_queued = max_queued
+        self._outbox: Dict[int, Deque[Tuple[str, bool]]] = {}
+        self._ready: Deque[int] = deque()
+        self._event = asyncio.Event()
+
+    def put(self, session: int, msg: str, replaceable: bool = False) -> None:
+        box = self._outbox.get(session)
+        if box is None:
+            box = self._outbox[session] = deque()
+            self._ready.append(session)
+        if replaceable and len(box) >= self._max_queued:
+            kept = [m for m in box if not m[1]]
+            box.clear()
+            box.extend(kept)
+        box.append((msg, replaceable))
+        self._event.set()
+
+    async def run(self) -> None:
+        while True:
+            while not self._ready:
+                self._event.clear()
+                await self._event.wait()
+            session = self._ready.popleft()
+            box = self._outbox[session]
+            msg, _ = box.popleft()
+            await self._ws.send_text(msg)
+            metrics.sent_chars.inc(len(msg))
+            if box:
+                self._ready.append(session)
+            else:
+                del self._outbox[session]
+
+
+def _is_replaceable(resp: Any) -> bool:
+    # interim results superseding each other (deltas build on each other)
+    return isinstance(resp, list) and not any(
+        r.is_final or any(isinstance(alt, SpeechRecognitionAlternativeDelta)
+                          for alt in r.alternatives) for r in resp)
+
+
+async def multiplex_endpoint(ws: WebSocket) -> None:
+    """Serve sessions opened by the client until it disconnects.
+
+    * text `{"type": "open", "session": <id>, ...init msg}` opens a session
+    * binary `<id: uint16 big endian><opus packet>` feeds a session
+    * text `{"type": "end", "session": <id>}` ends the audio of a session
+
+    Malformed messages are answered with an error message without a
+    session id, and a session whose packet queue is full (the engine does
+    not keep up) is aborted, so that neither stalls the other sessions.
+    """
+    sender = FairSender(ws)
+    sender_task = asyncio.create_task(sender.run())
+    sessions: Dict[int, Queue] = {}
+    tasks: Dict[int, Task] = {}
+    conn_id = '{:08x}'.format(random.getrandbits(32))
+
+    async def _run_session(
+            session: int, init_msg: Dict[str, Any], queue: Queue) -> None:
+        session_id = '{}/{}'.format(conn_id, session)
+        try:
+            async for resp in asr_endpoint(
+                    init_msg, queue.get, session_id=session_id):
+                sender.put(session, encode_response(resp, session),
+                           _is_replaceable(resp))
+        except Exception:
+            logger.exception('[%s] session failed', session_id)
+            sender.put(session, encode_response(SpeechRecognitionError(
+                SpeechRecognitionErrorCode.Aborted, 'internal error'),
+                session))
+        finally:
+            if sessions.get(session) is queue:  # not aborted / reopened
+                del sessions[session]
+                del tasks[session]
+
+    def _error(message: str) -> None:
+        sender.put(-1, encode_response(SpeechRecognitionError(
+            SpeechRecognitionErrorCode.ServiceNotAllowed, message)))
+
+    def _feed(session: int, data: bytes) -> None:
+        queue = sessions.get(session)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(data)
+        except QueueFull:
+            del sessions[session]
+            tasks.pop(session).cancel()
+            sender.put(session, encode_response(SpeechRecognitionError(
+                SpeechRecognitionErrorCode.Aborted,
+                'too many queued packets'), session))
+
+    def _open(msg: Dict[str, Any]) -> None:
+        session = msg['session']
+        if session in sessions or len(sessions) >= MAX_SESSIONS:
+            sender.put(session, encode_response(SpeechRecognitionError(
+                SpeechRecognitionErrorCode.ServiceNotAllowed,
+                'session is in use or too many sessions'), session))
+            return
+        queue: Queue = Queue(MAX_QUEUED_PACKETS)
+        sessions[session] = queue
+        tasks[session] = asyncio.create_task(
+            _run_session(session, msg, queue))
+
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg['type'] == 'websocket.disconnect':
+                break
+            if msg.get('bytes') is not None:
+                data = msg['bytes']
+                if len(data) < SESSION_ID.size:
+                    _error('binary message without session id')
+                    continue
+                _feed(SESSION_ID.unpack_from(data)[0],
+                      data[SESSION_ID.size:])
+                continue
+            try:
+                obj = json.loads(msg.get('text') or '')
+            except ValueError:
+                _error('invalid JSON message')
+                continue
+            session = obj.get('session') if isinstance(obj, dict) else None
+            if not isinstance(session, int) or isinstance(session, bool) \
+                    or not 0 <= session <= 0xffff:
+                _error('message without a valid session id')
+            elif obj.get('type') == 'open':
+                _open(obj)
+            elif obj.get('type') == 'end':
+                _feed(session, b'')
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        sender_task.cancel()
@@ -0,0 +1,36 @@
+"""Loading of native libraries (libogg, libopus).
+
+`ctypes.util.find_library` runs ldconfig / gcc in a subprocess, which is
+slow; the usual sonames are tried first and the result is cached, so each
+library is resolved once per process. `ASR_LIB<NAME>_PATH` (e.g.
+`ASR_LIBOPUS_PATH`) overrides the search.
+"""
+from ctypes import CDLL
+from ctypes.util import find_library
+from functools import lru_cache
+import os
+import sys
+
+_SONAMES = {
+    'ogg': ('libogg.so.0', 'libogg.0.dylib', 'ogg.dll', 'libogg-0.dll'),
+    'opus': ('libopus.so.0', 'libopus.0.dylib', 'opus.dll', 'libopus-0.dll'),
+}
+
+
+@lru_cache(maxsize=None)
+def load_library(name: str) -> CDLL:
+    path = os.environ.get('ASR_LIB{}_PATH'.format(name.upper()))
+    if path:
+        return CDLL(path)
+    for soname in _SONAMES.get(name, ()):
+        if sys.platform == 'darwin' and not soname.endswith('.dylib'):
+            continue
+        try:
+            return CDLL(soname)
+        except OSError:
+            pass
+    path = find_library(name)
+    if path is None:
+        raise OSError('lib{} not found (set ASR_LIB{}_PATH)'.format(
+            name, name.upper()))
+    return CDLL(path)
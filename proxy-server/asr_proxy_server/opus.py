@@ -3,25 +3,137 @@
 References:
 * RFC7845 Ogg Encapsulation for the Opus Audio Codec
   https://tools.ietf.org/html/rfc7845.html
+* RFC3533 The Ogg Encapsulation Format Version 0
+  https://tools.ietf.org/html/rfc3533.html
 """
+from functools import lru_cache
 import struct
-from typing import Sequence
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+import zlib
 
-TOC_CONFIG_TABLE = [
-    10, 20, 40, 60,  # SILK-only NB
-    10, 20, 40, 60,  # SILK-only MB
-    10, 20, 40, 60,  # SILK-only WB
-    10, 20,  # Hybrid SWB
-    10, 20,  # Hybrid SWB
-    2.5, 5, 10, 20,  # CELT-only NB
-    2.5, 5, 10, 20,  # CELT-only WB
-    2.5, 5, 10, 20,  # CELT-only SWB
-    2.5, 5, 10, 20,  # CELT-only FB
-]
+# samples per frame at 48kHz indexed by the config (toc >> 3)
+OPUS_CONFIG_FRAME_SAMPLES = (
+    480, 960, 1920, 2880,  # SILK-only NB
+    480, 960, 1920, 2880,  # SILK-only MB
+    480, 960, 1920, 2880,  # SILK-only WB
+    480, 960,  # Hybrid SWB
+    480, 960,  # Hybrid FB
+    120, 240, 480, 960,  # CELT-only NB
+    120, 240, 480, 960,  # CELT-only WB
+    120, 240, 480, 960,  # CELT-only SWB
+    120, 240, 480, 960,  # CELT-only FB
+)
+OPUS_MAX_FRAME_BYTES = 1275
+OPUS_MAX_PACKET_SAMPLES = 5760  # 120ms
 
+# indexed by the whole TOC byte. frame count 0 means the count is in the
+# frame count byte (code 3).
+_TOC_FRAME_SAMPLES = tuple(
+    OPUS_CONFIG_FRAME_SAMPLES[toc >> 3] for toc in range(256))
+_TOC_FRAME_COUNT = tuple((1, 2, 2, 0)[toc & 3] for toc in range(256))
 
-def get_opus_framesize_from_toc(toc: int) -> float:
-    return TOC_CONFIG_TABLE[toc >> 3]
+
+class OpusToc(NamedTuple):
+    mode: str  # 'silk', 'hybrid' or 'celt'
+    bandwidth: str  # 'nb', 'mb', 'wb', 'swb' or 'fb'
+    frame_samples: int  # samples per frame at 48kHz
+    stereo: bool
+    code: int  # frame count code (0: 1 frame, 1/2: 2 frames, 3: N frames)
+
+
+def _decode_toc(toc: int) -> OpusToc:
+    config = toc >> 3
+    if config < 12:
+        mode, bandwidth = 'silk', ('nb', 'mb', 'wb')[config // 4]
+    elif config < 16:
+        mode, bandwidth = 'hybrid', ('swb', 'fb')[(config - 12) // 2]
+    else:
+        mode, bandwidth = 'celt', ('nb', 'wb', 'swb', 'fb')[(config - 16) // 4]
+    return OpusToc(mode, bandwidth, OPUS_CONFIG_FRAME_SAMPLES[config],
+                   bool(toc & 4), toc & 3)
+
+
+OPUS_TOC_TABLE = tuple(_decode_toc(toc) for toc in range(256))
+
+
+class InvalidOpusPacket(ValueError):
+    pass
+
+
+def _parse_size(packet: Union[bytes, memoryview], pos: int,
+                end: int) -> Tuple[int, int]:
+    """Returns (frame length, position after the length) (RFC6716 3.2.1)"""
+    if pos >= end:
+        raise InvalidOpusPacket('missing frame length')
+    b = packet[pos]
+    if b < 252:
+        return b, pos + 1
+    if pos + 1 >= end:
+        raise InvalidOpusPacket('missing frame length')
+    return b + 4 * packet[pos + 1], pos + 2
+
+
+def opus_packet_samples(packet: Union[bytes, memoryview]) -> int:
+    """Returns the number of 48kHz samples in `packet`.
+
+    The framing of the packet is validated as `opus_packet_parse` of libopus
+    does (RFC6716 3.4 [R1]-[R7]). InvalidOpusPacket is raised for a
+    malformed packet.
+    """
+    n = len(packet)
+    if n == 0:
+        raise InvalidOpusPacket('empty packet')
+    toc = packet[0]
+    count = _TOC_FRAME_COUNT[toc]
+    if count == 1:
+        last_size = n - 1
+    elif toc & 3 == 1:
+        if not n & 1:
+            raise InvalidOpusPacket('odd payload length of code 1')
+        last_size = (n - 1) // 2
+    elif count == 2:
+        size, pos = _parse_size(packet, 1, n)
+        last_size = n - pos - size
+        if last_size < 0:
+            raise InvalidOpusPacket('frame length exceeds the packet')
+    else:
+        if n < 2:
+            raise InvalidOpusPacket('missing frame count byte')
+        ch = packet[1]
+        count = ch & 0x3f
+        if count == 0 or \
+                _TOC_FRAME_SAMPLES[toc] * count > OPUS_MAX_PACKET_SAMPLES:
+            raise InvalidOpusPacket('invalid frame count')
+        pos, end = 2, n
+        if ch & 0x40:  # padding
+            while True:
+                if pos >= end:
+                    raise InvalidOpusPacket('missing padding length')
+                p = packet[pos]
+                pos += 1
+                end -= 254 if p == 255 else p
+                if p != 255:
+                    break
+            if end < pos:
+                raise InvalidOpusPacket('padding exceeds the packet')
+        if ch & 0x80:  # VBR
+            last_size = end - pos
+            for _ in range(count - 1):
+                size, next_pos = _parse_size(packet, pos, end)
+                if size > end - next_pos:
+                    raise InvalidOpusPacket('frame length exceeds the packet')
+                last_size -= next_pos - pos + size
+                pos = next_pos
+            if last_size < 0:
+                raise InvalidOpusPacket('frame lengths exceed the packet')
+        else:
+            last_size, rem = divmod(end - pos, count)
+            if rem:
+                raise InvalidOpusPacket('payload length of CBR packet is not '
+                                        'a multiple of the frame count')
+    if last_size > OPUS_MAX_FRAME_BYTES:
+        raise InvalidOpusPacket('frame too long')
+    return _TOC_FRAME_SAMPLES[toc] * count
 
 
 def opus_header_packet(
@@ -54,3 +166,179 @@ def opus_comment_header_packet(
         in_utf8 = c.encode('utf8')
         ret += struct.pack('<I', len(in_utf8)) + in_utf8
     return ret
+
+
+# Ogg uses the non-reflected CRC-32 (poly 0x04c11db7, init 0, no final xor).
+# It equals the bit-reversed zlib CRC-32 of the bit-reversed input, which
+# lets zlib do the per-byte work in C.
+_BIT_REVERSE_TABLE = bytes(
+    int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+_OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+
+def ogg_crc32(data: Union[bytes, bytearray]) -> int:
+    crc = zlib.crc32(data.translate(_BIT_REVERSE_TABLE), 0xffffffff)
+    return int('{:032b}'.format(crc ^ 0xffffffff)[::-1], 2)
+
+
+@lru_cache(maxsize=1024)
+def _lacing_values(n_bytes: int) -> Tuple[int, ...]:
+    # the first segment of a packet is flagged with 0x100 (as libogg does)
+    # so that pages can tell whether they start with a continued packet.
+    ret = [255] * (n_bytes // 255) + [n_bytes % 255]
+    ret[0] |= 0x100
+    return tuple(ret)
+
+
+class OggMuxer(object):
+    """Single logical stream Ogg page muxer.
+
+    This is a drop-in replacement of `libogg.Ogg` and produces byte-identical
+    pages to libogg's ogg_stream_pageout/ogg_stream_flush. Several packets
+    can be batched into one page by calling `packetin` repeatedly before
+    `flush`.
+    """
+
+    def __init__(self, serialno: int) -> None:
+        self._serialno = serialno & 0xffffffff
+        self._pageno = 0
+        self._body = bytearray()
+        self._lacing: List[int] = []
+        self._granules: List[int] = []
+        self._b_o_s = False  # True after the first page is emitted
+        self._e_o_s = False
+
+    def packetin(self, packet: Union[bytes, bytearray, memoryview],
+                 granulepos: int,
+                 *, b_o_s: bool = False, e_o_s: bool = False) -> None:
+        # `b_o_s` is accepted for compatibility with libogg.Ogg; like libogg
+        # the first page is always flagged as the beginning of stream.
+        lacing = _lacing_values(len(packet))
+        self._body += packet
+        self._lacing.extend(lacing)
+        self._granules.extend([granulepos] * len(lacing))
+        if e_o_s:
+            self._e_o_s = True
+
+    def pageout(self) -> Optional[bytes]:
+        force = bool(self._lacing) and (self._e_o_s or not self._b_o_s)
+        return self._page(force)
+
+    def flush(self) -> Optional[bytes]:
+        return self._page(True)
+
+    def _page(self, force: bool, nfill: int = 4096) -> Optional[bytes]:
+        lacing = self._lacing
+        maxvals = min(len(lacing), 255)
+        if maxvals == 0:
+            return None
+
+        # decide how many segments to include (see ogg_stream_flush_i)
+        granulepos = -1
+        if not self._b_o_s:
+            # the initial header page only includes the first packet
+            granulepos, vals = 0, maxvals
+            for i in range(maxvals):
+                if (lacing[i] & 0xff) < 255:
+                    vals = i + 1
+                    break
+        else:
+            acc = packets_done = packet_just_done = vals = 0
+            while vals < maxvals:
+                if acc > nfill and packet_just_done >= 4:
+                    force = True
+                    break
+                val = lacing[vals] & 0xff
+                acc += val
+                if val < 255:
+                    granulepos = self._granules[vals]
+                    packets_done += 1
+                    packet_just_done = packets_done
+                else:
+                    packet_just_done = 0
+                vals += 1
+            if vals == 255:
+                force = True
+        if not force:
+            return None
+
+        header_type = 0
+        if (lacing[0] & 0x100) == 0:
+            header_type |= 0x01  # continued packet
+        if not self._b_o_s:
+            header_type |= 0x02  # first page of logical bitstream
+        if self._e_o_s and len(lacing) == vals:
+            header_type |= 0x04  # last page of logical bitstream
+        segments = bytes([v & 0xff for v in lacing[0:vals]])
+        body_len = sum(segments)
+        page = bytearray(_OGG_PAGE_HEADER.pack(
+            b'OggS', 0, header_type, granulepos, self._serialno,
+            self._pageno & 0xffffffff, 0, vals))
+        page += segments
+        page += memoryview(self._body)[0:body_len]
+        page[22:26] = struct.pack('<I', ogg_crc32(page))
+
+        self._b_o_s = True
+        self._pageno += 1
+        del self._body[0:body_len]
+        del lacing[0:vals]
+        del self._granules[0:vals]
+        return bytes(page)
+
+
+class OggPage(NamedTuple):
+    header_type: int
+    granulepos: int
+    serialno: int
+    pageno: int
+    segments: bytes  # lacing values
+    body: memoryview
+
+
+def iter_ogg_pages(data: Union[bytes, memoryview]) -> Iterator[OggPage]:
+    """Parse consecutive ogg pages in `data` without copying page bodies."""
+    buf, pos = memoryview(data), 0
+    while pos + 27 <= len(buf):
+        (capture, _, header_type, granulepos, serialno, pageno, _,
+         n_segments) = _OGG_PAGE_HEADER.unpack_from(buf, pos)
+        if capture != b'OggS':
+            raise ValueError('invalid ogg page at {}'.format(pos))
+        segments = buf[pos + 27:pos + 27 + n_segments].tobytes()
+        body_pos = pos + 27 + n_segments
+        pos = body_pos + sum(segments)
+        if pos > len(buf):
+            raise ValueError('truncated ogg page')
+        yield OggPage(header_type, granulepos, serialno, pageno, segments,
+                      buf[body_pos:pos])
+
+
+def iter_ogg_packets(data: Union[bytes, memoryview]) -> Iterator[bytes]:
+    """Demux the packets of a single logical stream ogg file."""
+    partial: List[bytes] = []
+    for page in iter_ogg_pages(data):
+        offset = 0
+        for val in page.segments:
+            partial.append(page.body[offset:offset + val].tobytes())
+            offset += val
+            if val < 255:
+                yield b''.join(partial)
+                partial.clear()
+
+
+def iter_ogg_page_bytes(
+        data: Union[bytes, memoryview]) -> Iterator[Tuple[OggPage, bytes]]:
+    """Like `iter_ogg_pages` but also yields the raw bytes of each page."""
+    pos = 0
+    for page in iter_ogg_pages(data):
+        end = pos + 27 + len(page.segments) + len(page.body)
+        yield page, bytes(data[pos:end])
+        pos = end
+
+
+def restamp_ogg_page(page: Union[bytes, memoryview], pageno: int,
+                     granulepos: int) -> bytes:
+    """Returns a copy of `page` with a new page number and granulepos."""
+    buf = bytearray(page)
+    struct.pack_into('<qxxxxII', buf, 6, granulepos, pageno, 0)
+    struct.pack_into('<I', buf, 22, ogg_crc32(buf))
+    return bytes(buf)
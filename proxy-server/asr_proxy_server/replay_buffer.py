@@ -0,0 +1,78 @@
+"""Bounded buffer of unacknowledged audio for upstream stream rollover."""
+from array import array
+from typing import Iterator, Tuple
+
+
+class ReplayBuffer(object):
+    """Ogg pages not yet covered by a final result.
+
+    Page bytes are stored back to back in one bytearray and the end offset /
+    end granulepos of each page in int64 arrays, so a buffered page costs
+    16 bytes on top of its data. Pages are numbered by `seq` in write order
+    (audio pages only). `trim` keeps at most `max_samples` (48kHz) of
+    audio, dropping the oldest pages even if they are not acknowledged.
+    """
+
+    def __init__(self, start_granulepos: int, max_samples: int) -> None:
+        self._data = bytearray()
+        self._ends = array('q')
+        self._granules = array('q')
+        self._head = 0  # index of the first live page in the arrays
+        self._max_samples = max_samples
+        self.first_seq = 0  # seq of the first live page
+        self.start_granulepos = start_granulepos  # of the first live page
+
+    def __len__(self) -> int:
+        return len(self._ends) - self._head
+
+    @property
+    def nbytes(self) -> int:
+        if not len(self):
+            return 0
+        return self._ends[-1] - self._start_offset()
+
+    @property
+    def end_granulepos(self) -> int:
+        return self._granules[-1] if len(self) else self.start_granulepos
+
+    def _start_offset(self) -> int:
+        return self._ends[self._head - 1] if self._head else 0
+
+    def append(self, page: bytes, granulepos: int) -> None:
+        self._data += page
+        self._ends.append(len(self._data))
+        self._granules.append(granulepos)
+
+    def trim(self, end_seq: int) -> None:
+        """Enforce `max_samples` by dropping pages before `end_seq`."""
+        while self.first_seq < end_seq and len(self) and \
+                self._granules[-1] - self.start_granulepos > \
+                self._max_samples:
+            self._popleft()
+
+    def ack(self, granulepos: int) -> None:
+        """Drop the pages whose audio ends at or before `granulepos`."""
+        while len(self) and self._granules[self._head] <= granulepos:
+            self._popleft()
+
+    def _popleft(self) -> None:
+        self.start_granulepos = self._granules[self._head]
+        self._head += 1
+        self.first_seq += 1
+        if self._head * 2 >= len(self._ends):
+            self._compact()
+
+    def _compact(self) -> None:
+        start = self._start_offset()
+        del self._data[:start]
+        self._ends = array('q', [x - start for x in self._ends[self._head:]])
+        self._granules = self._granules[self._head:]
+        self._head = 0
+
+    def pages(self, end_seq: int) -> Iterator[Tuple[bytes, int]]:
+        """Yields (page, start granulepos) of live pages before `end_seq`."""
+        start, granule = self._start_offset(), self.start_granulepos
+        n = min(len(self), end_seq - self.first_seq)
+        for i in range(self._head, self._head + n):
+            yield bytes(self._data[start:self._ends[i]]), granule
+            start, granule = self._ends[i], self._granules[i]
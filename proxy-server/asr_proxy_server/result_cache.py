@@ -0,0 +1,274 @@
+"""Cache of final results for replayed audio.
+
+A session with the `cache` option is buffered by CachingEngine until the
+end of audio instead of being streamed upstream. The opus packets and the
+recognition relevant part of the config are hashed as they arrive; on a
+hit the stored final results are returned without calling the engine, on
+a miss the buffered audio is sent to the engine and its final results are
+stored. Sessions with more than `ASR_RESULT_CACHE_MAX_BYTES` (default:
+4MiB) of audio bypass the cache: the buffered pages and the rest of the
+audio are streamed to the engine, and the results are not stored.
+
+The cache is shared by the sessions of a process and selected by
+`ASR_RESULT_CACHE`: `memory` (default) or `sqlite:<path>` (which is also
+shared by the workers of the supervisor), holding at most
+`ASR_RESULT_CACHE_SIZE` (default: 10000) entries in LRU order.
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from asyncio import Event, Queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from asr_proxy_server import metrics
+from asr_proxy_server.engine_base import (
+    Engine, SpeechRecognitionAlternative, SpeechRecognitionAlternativeWords,
+    SpeechRecognitionConfig, SpeechRecognitionDone, SpeechRecognitionError,
+    SpeechRecognitionResult, SpeechRecognitionResultList, WordTimings)
+from asr_proxy_server.opus import iter_ogg_packets
+
+# the final results of each response (as JSON objects)
+CachedResults = List[List[Dict[str, Any]]]
+
+logger = logging.getLogger(__name__)
+
+_cache: Optional['ResultCache'] = None
+
+
+class ResultCache(ABC):
+    @abstractmethod
+    async def get(self, key: bytes) -> Optional[CachedResults]:
+        pass
+
+    @abstractmethod
+    async def put(self, key: bytes, value: CachedResults) -> None:
+        pass
+
+
+class MemoryResultCache(ResultCache):
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._entries: 'OrderedDict[bytes, CachedResults]' = OrderedDict()
+
+    async def get(self, key: bytes) -> Optional[CachedResults]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    async def put(self, key: bytes, value: CachedResults) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+class SqliteResultCache(ResultCache):
+    """sqlite backed cache; `used` orders the entries for eviction.
+
+    The queries run in a thread of their own, since they block while
+    another worker holds the database lock (up to `timeout` seconds);
+    a lookup failing that way is a miss and a failed store is skipped.
+    """
+
+    def __init__(self, path: str, max_entries: int,
+                 timeout: float = 1.0) -> None:
+        self._max_entries = max_entries
+        self._executor = ThreadPoolExecutor(1, 'result-cache')
+        self._db = sqlite3.connect(path, isolation_level=None,
+                                   timeout=timeout, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key BLOB PRIMARY KEY, value TEXT NOT NULL, used INTEGER)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS results_used ON results(used)')
+
+    def _next_used(self) -> int:
+        row = self._db.execute('SELECT MAX(used) FROM results').fetchone()
+        return (row[0] or 0) + 1
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, fn, *args)
+
+    async def get(self, key: bytes) -> Optional[CachedResults]:
+        try:
+            return await self._run(self._get, key)
+        except sqlite3.OperationalError as e:  # e.g. database is locked
+            logger.warning('result cache lookup failed: %s', e)
+            return None
+
+    async def put(self, key: bytes, value: CachedResults) -> None:
+        try:
+            await self._run(self._put, key, value)
+        except sqlite3.OperationalError as e:
+            logger.warning('result cache store failed: %s', e)
+
+    def _get(self, key: bytes) -> Optional[CachedResults]:
+        row = self._db.execute(
+            'SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self._db.execute('UPDATE results SET used = ? WHERE key = ?',
+                         (self._next_used(), key))
+        return json.loads(row[0])
+
+    def _put(self, key: bytes, value: CachedResults) -> None:
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False),
+                 self._next_used()))
+            self._db.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results '
+                'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self._max_entries,))
+
+
+def get_cache() -> ResultCache:
+    global _cache
+    if _cache is None:
+        spec = os.environ.get('ASR_RESULT_CACHE', 'memory')
+        max_entries = int(os.environ.get('ASR_RESULT_CACHE_SIZE', 10000))
+        if spec.startswith('sqlite:'):
+            _cache = SqliteResultCache(spec[len('sqlite:'):], max_entries)
+        elif spec == 'memory':
+            _cache = MemoryResultCache(max_entries)
+        else:
+            raise ValueError('unknown ASR_RESULT_CACHE: {}'.format(spec))
+    return _cache
+
+
+def _alternative_from_dict(
+        obj: Dict[str, Any]) -> SpeechRecognitionAlternative:
+    if 'words' in obj:
+        return SpeechRecognitionAlternativeWords(
+            transcript=obj['transcript'], confidence=obj['confidence'],
+            words=WordTimings.from_dict(obj['words']))
+    return SpeechRecognitionAlternative(
+        transcript=obj['transcript'], confidence=obj['confidence'])
+
+
+def _result_from_dict(obj: Dict[str, Any]) -> SpeechRecognitionResult:
+    return SpeechRecognitionResult(
+        alternatives=[
+            _alternative_from_dict(alt) for alt in obj['alternatives']],
+        is_final=obj['is_final'])
+
+
+class CachingEngine(Engine):
+    """Wraps `engine` (named `engine_name`) with the result cache.
+
+    Interim results are only returned on a miss, after the end of audio,
+    or once more than `max_buffered_bytes` of pages were buffered (the
+    cache is bypassed then).
+    """
+
+    def __init__(self, engine: Engine, engine_name: str,
+                 cache: Optional[ResultCache] = None,
+                 max_buffered_bytes: Optional[int] = None) -> None:
+        self._engine = engine
+        self._engine_name = engine_name
+        self._cache = get_cache() if cache is None else cache
+        self._max_buffered_bytes = int(os.environ.get(
+            'ASR_RESULT_CACHE_MAX_BYTES', 2**22)) \
+            if max_buffered_bytes is None else max_buffered_bytes
+        self._config: Optional[SpeechRecognitionConfig] = None
+        self._hash = hashlib.blake2b(digest_size=20)
+        self._pages: List[bytes] = []
+        self._buffered_bytes = 0
+        self._key = b''
+        self._started = False  # `engine` is in use (cache miss or bypass)
+        self._bypassed = False
+        self._looked_up = Event()
+        self._finals: CachedResults = []
+        self._queue: Queue[Union[
+            SpeechRecognitionResultList, SpeechRecognitionDone]] = Queue()
+
+    async def init(self, config: SpeechRecognitionConfig) -> None:
+        self._config = config
+        # interim_results only affects interim results, which are not
+        # cached
+        self._hash.update(json.dumps([
+            self._engine_name, config.lang, config.continuous,
+            config.max_alternatives, config.engine,
+        ], sort_keys=True).encode('utf8'))
+
+    async def write_ogg_opus_page(self, page: bytes) -> None:
+        if self._bypassed:
+            await self._engine.write_ogg_opus_page(page)
+            return
+        # the packets (not the pages, which have a random serial number) are
+        # hashed; the comment header carries the client's encoder version
+        for packet in iter_ogg_packets(page):
+            if not packet.startswith(b'OpusTags'):
+                self._hash.update(struct.pack('<I', len(packet)))
+                self._hash.update(packet)
+        self._pages.append(page)
+        self._buffered_bytes += len(page)
+        if self._buffered_bytes > self._max_buffered_bytes:
+            metrics.result_cache_requests.inc(1, 'bypass')
+            self._bypassed = True
+            await self._start()
+
+    async def _start(self) -> None:
+        # start `engine` and write the buffered pages to it
+        self._started = True
+        try:
+            await self._engine.init(self._config)  # type: ignore
+        finally:
+            self._looked_up.set()
+        pages, self._pages = self._pages, []
+        for page in pages:
+            await self._engine.write_ogg_opus_page(page)
+
+    async def done(self) -> None:
+        if self._bypassed:
+            await self._engine.done()
+            return
+        self._key = self._hash.digest()
+        cached = await self._cache.get(self._key)
+        if cached is not None:
+            metrics.result_cache_requests.inc(1, 'hit')
+            self._pages.clear()
+            for results in cached:
+                self._queue.put_nowait(
+                    [_result_from_dict(r) for r in results])
+            self._queue.put_nowait(SpeechRecognitionDone())
+            self._looked_up.set()
+            return
+        metrics.result_cache_requests.inc(1, 'miss')
+        await self._start()
+        await self._engine.done()
+
+    async def get_result(self) -> Union[
+            SpeechRecognitionResultList, SpeechRecognitionDone]:
+        await self._looked_up.wait()
+        if not self._started:
+            return await self._queue.get()
+        try:
+            resp = await self._engine.get_result()
+        except SpeechRecognitionError:
+            self._key = b''  # never store results of a failed session
+            raise
+        if isinstance(resp, SpeechRecognitionDone):
+            if self._key:
+                await self._cache.put(self._key, self._finals)
+                self._key = b''
+        elif not self._bypassed:
+            finals = [json.loads(r.to_json()) for r in resp if r.is_final]
+            if finals:
+                self._finals.append(finals)
+        return resp
+
+    async def close(self) -> None:
+        if self._started:
+            await self._engine.close()
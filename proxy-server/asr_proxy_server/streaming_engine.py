@@ -0,0 +1,167 @@
+"""Async iterator based engine contract (v2).
+
+A StreamingEngine consumes the audio of a session as an async iterator
+(ogg opus pages, or int16 arrays for PcmEngine) and produces its results
+as an async iterator ending with SpeechRecognitionDone:
+
+    async for resp in engine.recognize(config, audio):
+        ...
+
+Errors are raised as SpeechRecognitionError from the iteration, and
+closing the result iterator (or cancelling the task iterating it) ends the
+session. Engines implementing the callback style `Engine` interface are
+wrapped by EngineAdapter.
+
+A StreamingEngine with a nonzero `pcm_sample_rate` is given the decoded
+audio (mono int16 arrays at that rate) instead of ogg pages, like PcmEngine.
+"""
+from abc import ABC, abstractmethod
+import asyncio
+from typing import Any, AsyncIterator, List, Optional, Set, Type, Union
+
+import numpy as np
+
+from asr_proxy_server import metrics
+from asr_proxy_server.engine_base import (
+    Engine, PcmEngine, SpeechRecognitionConfig, SpeechRecognitionDone,
+    SpeechRecognitionResultList)
+
+Audio = Union[bytes, np.ndarray]
+
+
+class StreamingEngine(ABC):
+    pcm_sample_rate = 0
+
+    @classmethod
+    async def startup(cls) -> None:
+        """Called once per process before the first session."""
+        pass
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        """Called once per process on server shutdown."""
+        pass
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of buffered requests not yet sent upstream (metrics)."""
+        return 0
+
+    @abstractmethod
+    def recognize(self, config: SpeechRecognitionConfig,
+                  audio: AsyncIterator[Audio]) -> AsyncIterator[Union[
+                      SpeechRecognitionResultList, SpeechRecognitionDone]]:
+        pass
+
+
+class EngineAdapter(StreamingEngine):
+    """Runs an `Engine` as a StreamingEngine.
+
+    The audio is written by one task per session while the results are
+    read in the iterating task.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        self.engine = engine
+        if isinstance(engine, PcmEngine):
+            self.pcm_sample_rate = engine.sample_rate
+
+    @property
+    def queue_depth(self) -> int:
+        return self.engine.queue_depth
+
+    async def _write(self, audio: AsyncIterator[Audio]) -> None:
+        engine = self.engine
+        loop = asyncio.get_event_loop()
+        async for data in audio:
+            start = loop.time()
+            if isinstance(data, bytes):
+                await engine.write_ogg_opus_page(data)
+            else:
+                await engine.write_pcm(data)  # type: ignore
+            metrics.page_write.observe(loop.time() - start)
+        await engine.done()
+
+    async def recognize(self, config: SpeechRecognitionConfig,
+                        audio: AsyncIterator[Audio]) -> AsyncIterator[Union[
+                            SpeechRecognitionResultList,
+                            SpeechRecognitionDone]]:
+        engine = self.engine
+        reader = asyncio.current_task()
+        writer: Optional[asyncio.Future] = None
+
+        def _on_written(fut: asyncio.Future) -> None:
+            # get_result does not return when writing failed
+            if not fut.cancelled() and fut.exception() is not None:
+                reader.cancel()  # type: ignore
+
+        try:
+            await engine.init(config)
+            writer = asyncio.ensure_future(self._write(audio))
+            writer.add_done_callback(_on_written)
+            while True:
+                try:
+                    resp = await engine.get_result()
+                except asyncio.CancelledError:
+                    if writer.done() and not writer.cancelled() and \
+                            writer.exception() is not None:
+                        raise writer.exception()  # type: ignore
+                    raise
+                yield resp
+                if isinstance(resp, SpeechRecognitionDone):
+                    return
+        finally:
+            if writer is not None:
+                writer.remove_done_callback(_on_written)
+                writer.cancel()
+                await asyncio.gather(writer, return_exceptions=True)
+            await engine.close()
+
+
+def as_streaming_engine(
+        engine: Union[Engine, StreamingEngine]) -> StreamingEngine:
+    if isinstance(engine, StreamingEngine):
+        return engine
+    return EngineAdapter(engine)
+
+
+try:
+    from asyncio import TaskGroup  # type: ignore
+except ImportError:  # python < 3.11
+    class TaskGroup(object):  # type: ignore
+        """Minimal `asyncio.TaskGroup`: when a task fails, the others and
+        the body are cancelled and the first error is raised."""
+
+        def __init__(self) -> None:
+            self._tasks: Set[asyncio.Task] = set()
+            self._parent: Optional[asyncio.Task] = None
+            self._error: Optional[BaseException] = None
+
+        async def __aenter__(self) -> 'TaskGroup':
+            self._parent = asyncio.current_task()
+            return self
+
+        def create_task(self, coro: Any) -> asyncio.Task:
+            task = asyncio.ensure_future(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._on_done)
+            return task
+
+        def _on_done(self, task: asyncio.Task) -> None:
+            if task.cancelled() or task.exception() is None:
+                return
+            if self._error is None:
+                self._error = task.exception()
+                for t in self._tasks:
+                    t.cancel()
+                self._parent.cancel()  # type: ignore
+
+        async def __aexit__(self, et: Optional[Type[BaseException]],
+                            exc: Optional[BaseException], tb: Any) -> None:
+            if et is not None:
+                for t in self._tasks:
+                    t.cancel()
+            pending: List[asyncio.Task] = list(self._tasks)
+            await asyncio.gather(*pending, return_exceptions=True)
+            if self._error is not None:
+                raise self._error
@@ -0,0 +1,145 @@
+"""Run the proxy in several worker processes sharing one listening socket.
+
+The supervisor binds the socket and passes it to `--workers` processes,
+each running the FastAPI `app` (with its own engine client pools) in
+uvicorn. Workers that exit unexpectedly are restarted. On SIGTERM / SIGINT
+every worker stops accepting connections and waits up to
+`--drain-timeout` seconds for its active sessions to end before closing
+the remaining connections.
+
+Usage: python -m asr_proxy_server.supervisor --port 8000 --workers 4
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+from multiprocessing.process import BaseProcess
+import os
+import signal
+import socket
+import tempfile
+import time
+from typing import Any, List, Optional
+
+import uvicorn  # type: ignore
+
+from asr_proxy_server import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn server that lets active sessions finish on shutdown."""
+
+    def __init__(self, config: uvicorn.Config, drain_timeout: float) -> None:
+        super().__init__(config)
+        self.drain_timeout = drain_timeout
+
+    async def shutdown(self, sockets: Optional[List[Any]] = None) -> None:
+        # stop accepting; the other workers keep serving the socket
+        for server in self.servers:
+            server.close()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.drain_timeout
+        while metrics.active_sessions.value() > 0 and \
+                loop.time() < deadline and not self.force_exit:
+            await asyncio.sleep(0.1)
+        if metrics.active_sessions.value() > 0:
+            logger.warning('closing %d active sessions',
+                           metrics.active_sessions.value())
+        await super().shutdown(sockets)
+
+
+def _run_worker(sock: socket.socket, drain_timeout: float,
+                log_level: str) -> None:
+    config = uvicorn.Config('asr_proxy_server:app', log_level=log_level)
+    DrainingServer(config, drain_timeout).run(sockets=[sock])
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor(object):
+    def __init__(self, sock: socket.socket, n_workers: int,
+                 drain_timeout: float, log_level: str,
+                 metrics_dir: str) -> None:
+        self._sock = sock
+        self._metrics_dir = metrics_dir
+        self._n_workers = n_workers
+        self._drain_timeout = drain_timeout
+        self._log_level = log_level
+        self._ctx = multiprocessing.get_context('spawn')
+        self._workers: List[BaseProcess] = []
+        self._should_exit = False
+
+    def _spawn(self) -> BaseProcess:
+        proc = self._ctx.Process(
+            target=_run_worker,
+            args=(self._sock, self._drain_timeout, self._log_level))
+        proc.start()
+        return proc
+
+    def _handle_signal(self, signum: int, frame: Any) -> None:
+        self._should_exit = True
+
+    def run(self) -> None:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self._handle_signal)
+        metrics.clear_snapshots(self._metrics_dir)
+        self._workers = [self._spawn() for _ in range(self._n_workers)]
+        while not self._should_exit:
+            for i, proc in enumerate(self._workers):
+                if not proc.is_alive():
+                    logger.warning('worker %d exited (%s), restarting',
+                                   proc.pid, proc.exitcode)
+                    # its counters and gauges are no longer reported
+                    metrics.remove_snapshot(
+                        self._metrics_dir, proc.pid)  # type: ignore
+                    self._workers[i] = self._spawn()
+            time.sleep(0.5)
+
+        for proc in self._workers:
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGTERM)  # type: ignore
+        deadline = time.monotonic() + self._drain_timeout + 5
+        for proc in self._workers:
+            proc.join(max(0, deadline - time.monotonic()))
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='max seconds to wait for active sessions')
+    parser.add_argument('--metrics-dir',
+                        help='directory of per-worker metrics snapshots '
+                        '(default: a temporary directory)')
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+
+    with tempfile.TemporaryDirectory(prefix='asr-metrics-') as tmp:
+        # inherited by the (spawned) workers
+        metrics_dir = os.environ['ASR_METRICS_DIR'] = \
+            args.metrics_dir or tmp
+        sock = _bind(args.host, args.port)
+        try:
+            Supervisor(sock, args.workers, args.drain_timeout,
+                       args.log_level, metrics_dir).run()
+        finally:
+            sock.close()
+
+
+if __name__ == '__main__':
+    main()
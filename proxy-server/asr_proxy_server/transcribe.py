@@ -0,0 +1,238 @@
+"""Offline transcription of recorded Ogg Opus / WAV files.
+
+Files are memory-mapped and demuxed (Ogg Opus) or encoded (16bit PCM WAV,
+with libopus) packet by packet and fed to `asr_endpoint` as fast as the
+engine accepts them, so the usual page batching and engines apply. Final
+results are written as JSON lines:
+
+    {"file": <path>, "result": <result>}
+    {"file": <path>, "error": <error message>}
+
+Usage: python -m asr_proxy_server.transcribe [--engine dummy] FILE...
+"""
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from typing import (
+    IO, Any, AsyncIterator, Dict, Iterable, Iterator, NamedTuple, Optional,
+    TextIO)
+
+from asr_proxy_server.asr_endpoint import asr_endpoint
+from asr_proxy_server.engine_base import SpeechRecognitionError
+from asr_proxy_server.engine_registry import ENGINES
+from asr_proxy_server.ingest import OPUS_SAMPLE_RATES
+from asr_proxy_server.messages import json_dumps
+from asr_proxy_server.opus import iter_ogg_packets
+
+_WAV_FORMAT_PCM = 1
+_WAV_FORMAT_EXTENSIBLE = 0xfffe
+
+_upload_semaphore: Optional[asyncio.Semaphore] = None
+
+
+class AudioSource(NamedTuple):
+    pre_skip: int
+    version: str  # encoder vendor string
+    packets: Iterator[bytes]  # opus packets (must be closed)
+
+
+def open_ogg_opus(buf: Any) -> AudioSource:
+    packets = iter_ogg_packets(buf)
+    head = next(packets, b'')
+    if not head.startswith(b'OpusHead'):
+        packets.close()
+        raise ValueError('not an ogg opus stream')
+    pre_skip = struct.unpack_from('<H', head, 10)[0]
+    tags, vendor = next(packets, b''), ''
+    if tags.startswith(b'OpusTags'):
+        n = struct.unpack_from('<I', tags, 8)[0]
+        vendor = tags[12:12 + n].decode('utf8', 'replace')
+    return AudioSource(pre_skip, vendor, packets)
+
+
+def _wav_chunks(buf: Any) -> Dict[bytes, range]:
+    if buf[0:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        raise ValueError('not a RIFF/WAVE file')
+    ret, pos = {}, 12
+    while pos + 8 <= len(buf):
+        chunk_id, size = struct.unpack_from('<4sI', buf, pos)
+        end = min(pos + 8 + size, len(buf))  # tolerate truncated files
+        ret.setdefault(chunk_id, range(pos + 8, end))
+        pos = end + (size & 1)
+    return ret
+
+
+def _encode_pcm(buf: Any, data: range, fs: int, ch: int,
+                encoder: Any) -> Iterator[bytes]:
+    frame_bytes = fs // 50 * ch * 2  # 20ms
+    with memoryview(buf) as view:
+        for pos in range(data.start, data.stop, frame_bytes):
+            frame = view[pos:min(pos + frame_bytes, data.stop)]
+            if len(frame) < frame_bytes:
+                frame = bytes(frame) + bytes(frame_bytes - len(frame))
+            yield encoder.encode(frame)
+            del frame  # no export of `buf` may outlive the generator
+
+
+def open_wav(buf: Any) -> AudioSource:
+    chunks = _wav_chunks(buf)
+    if b'fmt ' not in chunks or b'data' not in chunks:
+        raise ValueError('fmt or data chunk not found')
+    fmt = chunks[b'fmt ']
+    tag, ch, fs, _, _, bits = struct.unpack_from('<HHIIHH', buf, fmt.start)
+    if tag == _WAV_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        tag = struct.unpack_from('<H', buf, fmt.start + 24)[0]
+    if tag != _WAV_FORMAT_PCM or bits != 16 or ch not in (1, 2):
+        raise ValueError('only 16bit mono/stereo PCM is supported')
+    if fs not in OPUS_SAMPLE_RATES:
+        raise ValueError('unsupported sample rate: {}'.format(fs))
+    from asr_proxy_server.libopus import OpusEncoder, version_string
+    encoder = OpusEncoder(fs, ch)
+    return AudioSource(
+        encoder.lookahead * 48000 // fs, 'libopus ' + version_string(),
+        _encode_pcm(buf, chunks[b'data'], fs, ch, encoder))
+
+
+def open_audio(buf: Any) -> AudioSource:
+    if buf[0:4] == b'OggS':
+        return open_ogg_opus(buf)
+    return open_wav(buf)
+
+
+def _error_line(path: str, message: str) -> str:
+    return '{"file":%s,"error":%s}' % (json_dumps(path), json_dumps(message))
+
+
+async def transcribe_file(
+        path: str, engine: str, engine_config: Dict[str, Any],
+        name: Optional[str] = None) -> AsyncIterator[str]:
+    """Yields JSON lines of the final results of `path`.
+
+    `name` is written as "file" instead of `path` if given.
+    """
+    name = path if name is None else name
+    file_json = json_dumps(name)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError('empty file')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        source = open_audio(buf)
+        try:
+            header = {
+                'pre_skip': source.pre_skip,
+                'version': source.version,
+                'engine': engine,
+                'engine-config': engine_config,
+            }
+
+            async def receive_bytes() -> bytes:
+                return next(source.packets, b'')
+
+            async for resp in asr_endpoint(
+                    header, receive_bytes, session_id=path):
+                if isinstance(resp, SpeechRecognitionError):
+                    yield _error_line(name, resp.message or resp.error.value)
+                elif isinstance(resp, list):
+                    for r in resp:
+                        if r.is_final:
+                            yield '{"file":%s,"result":%s}' % (
+                                file_json, r.to_json())
+        finally:
+            source.packets.close()
+    finally:
+        buf.close()
+
+
+async def _transcribe_to(path: str, out: TextIO, engine: str,
+                         engine_config: Dict[str, Any]) -> None:
+    try:
+        async for line in transcribe_file(path, engine, dict(engine_config)):
+            out.write(line + '\n')
+            out.flush()
+    except Exception as e:
+        out.write(_error_line(path, repr(e)) + '\n')
+        out.flush()
+
+
+async def transcribe_files(
+        paths: Iterable[str], out: TextIO, *, engine: str,
+        engine_config: Dict[str, Any], concurrency: int = 4) -> None:
+    """Transcribe `paths`, at most `concurrency` files at a time."""
+    it = iter(paths)
+
+    async def _worker() -> None:
+        for path in it:
+            await _transcribe_to(path, out, engine, engine_config)
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+
+
+async def spool_upload(chunks: AsyncIterator[bytes]) -> IO[bytes]:
+    """Write an uploaded file to a temporary file (deleted on close)."""
+    f = tempfile.NamedTemporaryFile(prefix='asr-upload-')
+    try:
+        async for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+async def transcribe_upload(
+        f: IO[bytes], engine: str, engine_config: Dict[str, Any],
+        name: str = '') -> AsyncIterator[str]:
+    """Yield the JSON lines of a spooled upload and close it.
+
+    At most ASR_TRANSCRIBE_CONCURRENCY uploads (default: 4) are transcribed
+    at a time; the others wait for their turn.
+    """
+    global _upload_semaphore
+    if _upload_semaphore is None:
+        _upload_semaphore = asyncio.Semaphore(
+            int(os.environ.get('ASR_TRANSCRIBE_CONCURRENCY', 4)))
+    with f:
+        async with _upload_semaphore:
+            try:
+                async for line in transcribe_file(
+                        f.name, engine, engine_config, name):
+                    yield line + '\n'
+            except Exception as e:
+                yield _error_line(name, repr(e)) + '\n'
+
+
+async def _main(args: argparse.Namespace) -> None:
+    engine_config = json.loads(args.config)
+    out = sys.stdout if args.output == '-' else open(
+        args.output, 'w', encoding='utf8')
+    try:
+        await transcribe_files(
+            args.files, out, engine=args.engine,
+            engine_config=engine_config, concurrency=args.concurrency)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        await ENGINES.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Transcribe Ogg Opus / WAV files to JSON lines')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--engine', default='google-v1',
+                        choices=ENGINES.names())
+    parser.add_argument('--config', default='{}',
+                        help='engine-config object (JSON)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('-o', '--output', default='-')
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Server-side voice activity detection and silence trimming."""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Deque, List
+
+import numpy as np
+
+from asr_proxy_server.engine_base import WordTimings
+
+
+class SilenceTrimmer(object):
+    """Drops long silent stretches from a mono 48kHz Opus packet stream.
+
+    Every packet is decoded (to keep the decoder state intact) and is
+    classified as speech when the energy of any of its 10ms sub-frames
+    exceeds `threshold` [dBFS]. Silent packets are still forwarded for
+    `hangover` ms after the last speech packet, and the last `preroll` ms
+    of dropped packets are forwarded again when speech resumes so that the
+    onset is not clipped.
+    """
+
+    def __init__(self, *, threshold: float = -50.0, hangover: int = 500,
+                 preroll: int = 200) -> None:
+        from asr_proxy_server.libopus import OpusDecoder
+        self._decoder = OpusDecoder(48000, 1)
+        self._threshold = 10 ** (threshold / 10)
+        self._hangover = hangover * 48
+        self._preroll = preroll * 48
+        self._silence = 0  # samples since the last speech packet
+        self._dropped: Deque[bytes] = deque()
+        self._dropped_sizes: Deque[int] = deque()
+        self._n_dropped_preroll = 0
+        self.n_dropped_samples = 0
+
+    @property
+    def dropped_seconds(self) -> float:
+        return self.n_dropped_samples / 48000
+
+    def process(self, packet: bytes) -> List[bytes]:
+        """Return the packets to be forwarded upstream (in order)."""
+        pcm = self._decoder.decode(packet, dtype=np.float32)
+        n_samples = len(pcm)
+        if self._is_speech(pcm):
+            self._silence = 0
+            ret = list(self._dropped)
+            self.n_dropped_samples -= self._n_dropped_preroll
+            self._dropped.clear()
+            self._dropped_sizes.clear()
+            self._n_dropped_preroll = 0
+            ret.append(packet)
+            return ret
+
+        self._silence += n_samples
+        if self._silence <= self._hangover:
+            return [packet]
+        self.n_dropped_samples += n_samples
+        self._dropped.append(packet)
+        self._dropped_sizes.append(n_samples)
+        self._n_dropped_preroll += n_samples
+        while self._n_dropped_preroll - self._dropped_sizes[0] >= \
+                self._preroll:
+            self._dropped.popleft()
+            self._n_dropped_preroll -= self._dropped_sizes.popleft()
+        return []
+
+    def _is_speech(self, pcm: np.ndarray) -> bool:
+        frame_size = min(480, len(pcm))
+        if frame_size == 0:
+            return False
+        frames = pcm[0:len(pcm) - len(pcm) % frame_size].reshape(
+            -1, frame_size)
+        energy = np.einsum('ij,ij->i', frames, frames) / frame_size
+        return bool(energy.max() > self._threshold)
+
+
+class GranuleMap(object):
+    """Maps granule positions of the trimmed stream to the client's stream.
+
+    The endpoint calls `add(pos, offset)` whenever the number of samples
+    dropped before trimmed position `pos` changes to `offset`.
+    """
+
+    def __init__(self) -> None:
+        self._pos = array('q')
+        self._offset = array('q')
+
+    def add(self, pos: int, offset: int) -> None:
+        if self._offset and self._offset[-1] == offset:
+            return
+        if self._pos and self._pos[-1] == pos:
+            self._offset[-1] = offset
+        else:
+            self._pos.append(pos)
+            self._offset.append(offset)
+
+    def __call__(self, pos: int, end: bool = False) -> int:
+        """Client granulepos of `pos` (an `end` position at a cut belongs
+        to the audio before the cut)."""
+        i = (bisect_left if end else bisect_right)(self._pos, pos) - 1
+        return pos + (self._offset[i] if i >= 0 else 0)
+
+    def map_words(self, words: WordTimings) -> None:
+        """Map `words` to the client's stream (in place)."""
+        for i in range(len(words)):
+            words.start[i] = self(words.start[i])
+            words.end[i] = self(words.end[i], end=True)
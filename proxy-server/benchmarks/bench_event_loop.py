@@ -0,0 +1,99 @@
+"""Event loop overhead of asr_endpoint per audio packet.
+
+Runs `--sessions` concurrent sessions of `--packets` 20ms packets each
+through asr_endpoint with DummyEngine (packets are received without delay,
+so the time is spent in the endpoint, the engine adapter and the event
+loop), and reports the CPU time per packet and the number of tasks created
+per packet. The baseline only receives the packets.
+
+Usage: python benchmarks/bench_event_loop.py [--uvloop] [--page-packets N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# 20ms CELT-only fullband frame (config 31, code 0) at ~32kbps
+OPUS_20MS_PACKET = bytes([31 << 3]) + os.urandom(79)
+
+
+def _receiver(n_packets: int) -> Callable[[], Awaitable[bytes]]:
+    remaining = n_packets
+
+    async def _receive() -> bytes:
+        nonlocal remaining
+        await asyncio.sleep(0)  # like a socket read: yield to the loop
+        if not remaining:
+            return b''
+        remaining -= 1
+        return OPUS_20MS_PACKET
+    return _receive
+
+
+async def _baseline(n_packets: int) -> None:
+    receive = _receiver(n_packets)
+    while await receive():
+        pass
+
+
+async def _session(n_packets: int, engine_config: Dict[str, Any]) -> None:
+    from asr_proxy_server.asr_endpoint import asr_endpoint
+    header = {'pre_skip': 312, 'version': 'bench', 'engine': 'dummy',
+              'engine-config': engine_config}
+    async for _ in asr_endpoint(header, _receiver(n_packets)):
+        pass
+
+
+async def _run(args: argparse.Namespace, baseline: bool) -> None:
+    engine_config = {'page_packets': args.page_packets}
+    loop = asyncio.get_event_loop()
+    n_tasks = 0
+    task_factory = loop.get_task_factory()
+
+    def _count_tasks(loop: Any, coro: Any, **kwargs: Any) -> asyncio.Task:
+        nonlocal n_tasks
+        n_tasks += 1
+        if task_factory is not None:
+            return task_factory(loop, coro, **kwargs)
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    loop.set_task_factory(_count_tasks)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*[
+        _baseline(args.packets) if baseline
+        else _session(args.packets, engine_config)
+        for _ in range(args.sessions)])
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+    loop.set_task_factory(task_factory)
+    n = args.sessions * args.packets
+    print('{:10s} {:8.1f} us/packet (cpu) {:8.1f} us/packet (wall) '
+          '{:6.3f} tasks/packet'.format(
+              'baseline' if baseline else 'endpoint',
+              cpu / n * 1e6, wall / n * 1e6, (n_tasks - args.sessions) / n))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--packets', type=int, default=500)
+    parser.add_argument('--page-packets', type=int, default=1)
+    parser.add_argument('--uvloop', action='store_true',
+                        help='run on uvloop (must be installed)')
+    args = parser.parse_args()
+
+    if args.uvloop:
+        import uvloop
+        uvloop.install()
+    import logging
+    logging.disable(logging.INFO)
+    for baseline in (True, False):
+        asyncio.run(_run(args, baseline))
+
+
+if __name__ == '__main__':
+    main()
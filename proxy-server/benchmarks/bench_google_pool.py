@@ -0,0 +1,106 @@
+"""Time-to-first-request of GoogleSpeechToTextV1 against a fake server.
+
+A local gRPC server implements google.cloud.speech.v1.Speech/
+StreamingRecognize, so the cost of creating a channel per session can be
+compared with leasing one from the shared SpeechClientPool offline.
+
+Usage: python benchmarks/bench_google_pool.py [--sessions N] [--no-pool]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import Any, AsyncIterator, Dict, List
+
+import google.cloud.speech_v1 as V1  # type: ignore
+from google.cloud.speech_v1.services.speech.transports import \
+    SpeechGrpcAsyncIOTransport  # type: ignore
+import grpc  # type: ignore
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from asr_proxy_server.engine_base import SpeechRecognitionConfig  # noqa: E402
+from asr_proxy_server.google_speech_to_text import (  # noqa: E402
+    GoogleSpeechToTextV1, SpeechClientPool)
+
+# session id (language_code) -> time the first audio request arrived
+FIRST_REQUEST_AT: Dict[str, float] = {}
+
+
+async def _streaming_recognize(
+        request_iterator: AsyncIterator[Any], context: Any
+) -> AsyncIterator[Any]:
+    session = None
+    async for req in request_iterator:
+        if session is None:
+            session = req.streaming_config.config.language_code
+        elif session not in FIRST_REQUEST_AT:
+            FIRST_REQUEST_AT[session] = time.perf_counter()
+    yield V1.StreamingRecognizeResponse(results=[
+        V1.StreamingRecognitionResult(is_final=True, alternatives=[
+            V1.SpeechRecognitionAlternative(transcript='fake')])])
+
+
+async def _start_server() -> Any:
+    server = grpc.aio.server()
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(
+        'google.cloud.speech.v1.Speech', {
+            'StreamingRecognize': grpc.stream_stream_rpc_method_handler(
+                _streaming_recognize,
+                request_deserializer=V1.StreamingRecognizeRequest.deserialize,
+                response_serializer=V1.StreamingRecognizeResponse.serialize,
+            )}),))
+    port = server.add_insecure_port('127.0.0.1:0')
+    await server.start()
+    return server, '127.0.0.1:{}'.format(port)
+
+
+def _pool(address: str) -> SpeechClientPool:
+    def _client() -> Any:
+        return V1.services.speech.SpeechAsyncClient(
+            transport=SpeechGrpcAsyncIOTransport(
+                channel=grpc.aio.insecure_channel(address)))
+    return SpeechClientPool(_client)
+
+
+async def _session(i: int, address: str, shared: bool) -> float:
+    if not shared:
+        # the behaviour before the pool: one channel per session
+        GoogleSpeechToTextV1.use_client_pool(_pool(address))
+    session = 'session-{}'.format(i)
+    start = time.perf_counter()
+    engine = GoogleSpeechToTextV1()
+    await engine.init(SpeechRecognitionConfig.parse({'lang': session}))
+    await engine.write_ogg_opus_page(b'OggS' + bytes(100))
+    await engine.done()
+    await engine.get_result()
+    await engine.close()
+    if not shared:
+        await GoogleSpeechToTextV1.client_pool().close()
+    return FIRST_REQUEST_AT[session] - start
+
+
+async def main(n_sessions: int, shared: bool) -> None:
+    server, address = await _start_server()
+    if shared:
+        GoogleSpeechToTextV1.use_client_pool(_pool(address))
+        await GoogleSpeechToTextV1.startup()
+    latencies: List[float] = []
+    for i in range(n_sessions):
+        latencies.append(await _session(i, address, shared))
+    await GoogleSpeechToTextV1.shutdown()
+    await server.stop(None)
+    latencies.sort()
+    print('{} sessions, {}: p50={:.2f}ms p99={:.2f}ms'.format(
+        n_sessions, 'shared pool' if shared else 'channel per session',
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--no-pool', action='store_true')
+    args = parser.parse_args()
+    asyncio.run(main(args.sessions, not args.no_pool))
@@ -0,0 +1,66 @@
+"""Throughput of LocalCtcEngine with and without cross-session batching.
+
+Runs `--sessions` concurrent sessions of random audio through the engine
+(skipping opus decoding) for each `--batch` size and prints seconds of
+audio recognized per second.
+
+Usage: python benchmarks/bench_local_ctc.py --sessions 64 --batch 1,8,32
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from asr_proxy_server.engine_base import (  # noqa: E402
+    SpeechRecognitionConfig, SpeechRecognitionDone)
+from asr_proxy_server.local_ctc_engine import (  # noqa: E402
+    BatchScheduler, LocalCtcEngine, load_model)
+
+
+async def _session(audio: np.ndarray, frame: int) -> None:
+    engine = LocalCtcEngine()
+    await engine.init(SpeechRecognitionConfig.parse({}))
+    for i in range(0, len(audio), frame):
+        await engine.write_pcm(audio[i:i + frame])
+    await engine.done()
+    while not isinstance(await engine.get_result(), SpeechRecognitionDone):
+        pass
+
+
+async def measure(batch_size: int, args: argparse.Namespace) -> float:
+    LocalCtcEngine.use_scheduler(BatchScheduler(
+        load_model(), max_batch_size=batch_size,
+        max_wait=args.max_wait / 1000))
+    rng = np.random.RandomState(0)
+    n = int(args.seconds * LocalCtcEngine.sample_rate)
+    audio = [(rng.randn(n) * 3000).astype(np.int16)
+             for _ in range(args.sessions)]
+    frame = LocalCtcEngine.sample_rate // 50  # 20ms packets
+    start = time.perf_counter()
+    await asyncio.gather(*[_session(a, frame) for a in audio])
+    elapsed = time.perf_counter() - start
+    await LocalCtcEngine.shutdown()
+    return args.sessions * args.seconds / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=10.0,
+                        help='audio length of each session')
+    parser.add_argument('--batch', default='1,8,32')
+    parser.add_argument('--max-wait', type=float, default=10.0,
+                        help='max batching delay [ms]')
+    args = parser.parse_args()
+
+    for batch_size in [int(x) for x in args.batch.split(',')]:
+        rate = asyncio.run(measure(batch_size, args))
+        print('batch {:3d}: {:8.1f} audio sec/sec'.format(batch_size, rate))
+
+
+if __name__ == '__main__':
+    main()
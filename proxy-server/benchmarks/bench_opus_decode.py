@@ -0,0 +1,69 @@
+"""Opus decoding throughput of OpusDecoder.decode / decode_many.
+
+Encodes `--seconds` of noise into 20ms packets and decodes them packet
+by packet (into the decoder's buffer and into a caller-provided array)
+and with one `decode_many` call, as int16 and float32.
+
+Usage: python benchmarks/bench_opus_decode.py --fs 16000
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Callable, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _bench(name: str, func: Callable[[], object], seconds: float,
+           repeat: int) -> None:
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print('{:24s} {:8.1f}x realtime'.format(name, seconds / elapsed))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fs', type=int, default=48000)
+    parser.add_argument('--seconds', type=float, default=60.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from asr_proxy_server.libopus import OpusDecoder, OpusEncoder
+
+    frame = args.fs // 50
+    pcm = (np.random.RandomState(0).randn(
+        int(args.seconds * 50) * frame) * 3000).astype(np.int16)
+    encoder = OpusEncoder(args.fs, 1)
+    packets: List[bytes] = [
+        encoder.encode(pcm[i:i + frame].tobytes())
+        for i in range(0, len(pcm), frame)]
+    decoder = OpusDecoder(args.fs, 1)
+
+    for dtype in (np.int16, np.float32):
+        out = np.empty(len(pcm), dtype)
+        name = np.dtype(dtype).name
+
+        def _loop() -> None:
+            for packet in packets:
+                decoder.decode(packet, dtype=dtype)
+
+        def _loop_out() -> None:
+            pos = 0
+            for packet in packets:
+                pos += len(decoder.decode(packet, out[pos:]))
+
+        _bench('decode ' + name, _loop, args.seconds, args.repeat)
+        _bench('decode(out) ' + name, _loop_out, args.seconds, args.repeat)
+        _bench('decode_many ' + name,
+               lambda: decoder.decode_many(packets, out), args.seconds,
+               args.repeat)
+
+
+if __name__ == '__main__':
+    main()
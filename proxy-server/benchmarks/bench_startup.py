@@ -0,0 +1,74 @@
+"""Server cold start time.
+
+Measures, over `--runs` fresh processes, the time to import the
+`asr_proxy_server` package and the time from starting uvicorn until the
+first connection is accepted and served (`GET /utilization`).
+
+Usage: python benchmarks/bench_startup.py --runs 5 [--preload google-v1]
+"""
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+from loadtest import _free_port  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+def import_time() -> float:
+    out = subprocess.check_output(
+        [sys.executable, '-c',
+         'import time; t = time.perf_counter(); import asr_proxy_server; '
+         'print(time.perf_counter() - t)'], cwd=ROOT)
+    return float(out)
+
+
+def first_connection_time(preload: str, timeout: float = 60.0) -> float:
+    port = _free_port()
+    env = dict(os.environ, ASR_PRELOAD_ENGINES=preload)
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asr_proxy_server:app',
+         '--port', str(port), '--log-level', 'warning'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            try:
+                conn.request('GET', '/utilization')
+                conn.getresponse().read()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.005)
+            finally:
+                conn.close()
+        raise TimeoutError('server did not start')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--preload', default='',
+                        help='ASR_PRELOAD_ENGINES of the server')
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.runs)]
+    starts = [first_connection_time(args.preload) for _ in range(args.runs)]
+    for name, values in (('import', imports),
+                         ('first connection', starts)):
+        print('{:18s} median {:6.0f}ms  min {:6.0f}ms  max {:6.0f}ms'.format(
+            name, statistics.median(values) * 1000, min(values) * 1000,
+            max(values) * 1000))
+
+
+if __name__ == '__main__':
+    main()
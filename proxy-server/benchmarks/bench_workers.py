@@ -0,0 +1,83 @@
+"""Session capacity of the supervisor as workers are added.
+
+For each worker count, starts `python -m asr_proxy_server.supervisor`
+and drives it with as many load generator processes as there are workers
+(so the client does not become the bottleneck), each running
+`--sessions` DummyEngine sessions `--concurrency` at a time as fast as
+possible. Prints sessions/sec and the speedup over one worker.
+
+Usage: python benchmarks/bench_workers.py --workers 1,2,4,8
+"""
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Tuple
+
+sys.path.insert(0, os.path.dirname(__file__))
+from loadtest import INIT_MSG, _free_port, load_packets, run  # noqa: E402
+
+
+def _client(url: str, n_sessions: int, concurrency: int,
+            seconds: float) -> Tuple[int, float]:
+    packets = load_packets(None, seconds)
+    stats, elapsed = asyncio.run(run(
+        url, n_sessions, concurrency, INIT_MSG, packets, 0))
+    return n_sessions - stats.errors, elapsed
+
+
+def _start_supervisor(port: int, n_workers: int) -> subprocess.Popen:
+    cwd = os.path.join(os.path.dirname(__file__), '..')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'asr_proxy_server.supervisor',
+         '--port', str(port), '--workers', str(n_workers),
+         '--log-level', 'warning', '--drain-timeout', '1'],
+        cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # the socket is bound before the workers start; give them time to
+    # import the app so that all of them are accepting
+    time.sleep(3 + n_workers * 0.5)
+    return proc
+
+
+def measure(n_workers: int, args: argparse.Namespace) -> float:
+    port = _free_port()
+    proc = _start_supervisor(port, n_workers)
+    url = 'ws://127.0.0.1:{}/ws'.format(port)
+    try:
+        with ProcessPoolExecutor(n_workers) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(
+                _client, [url] * n_workers, [args.sessions] * n_workers,
+                [args.concurrency] * n_workers, [args.seconds] * n_workers))
+            elapsed = time.perf_counter() - start
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+    return sum(n for n, _ in results) / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', default=','.join(
+        str(1 << i) for i in range((os.cpu_count() or 1).bit_length())))
+    parser.add_argument('--sessions', type=int, default=200,
+                        help='sessions per load generator process')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=3.0,
+                        help='audio length of each session')
+    args = parser.parse_args()
+
+    base = None
+    for n in [int(x) for x in args.workers.split(',')]:
+        rate = measure(n, args)
+        base = base or rate
+        print('{:3d} workers: {:8.1f} sessions/sec (x{:.2f})'.format(
+            n, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main()
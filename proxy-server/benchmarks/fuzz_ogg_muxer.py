@@ -0,0 +1,97 @@
+"""Fuzz `OggMuxer` against libogg.
+
+Random streams (packet sizes around the lacing boundaries of 255 bytes
+and beyond the 4096 byte page fill, batches of several packets, empty
+packets and end of stream) are muxed by `opus.OggMuxer` and
+`libogg.Ogg` in lockstep, draining pages with `pageout` or `flush` at
+random; every call must return byte-identical pages. libogg is looked
+up like by the server (`ASR_LIBOGG_PATH` sets its path).
+
+Usage: python benchmarks/fuzz_ogg_muxer.py --iterations 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Any, List, Optional, Type
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from asr_proxy_server.opus import OggMuxer  # noqa: E402
+
+
+def random_packet_size(rng: random.Random) -> int:
+    kind = rng.randrange(5)
+    if kind == 0:  # around multiples of 255 (lacing)
+        return 255 * rng.randrange(0, 20) + rng.choice((-1, 0, 1))
+    if kind == 1:  # large (more than one page fill / 255 segments)
+        return rng.randrange(4000, 70000)
+    if kind == 2:
+        return 0
+    return rng.randrange(1, 400)  # typical opus packets
+
+
+def _drain(muxer: Any, flush: bool) -> List[Optional[bytes]]:
+    ret = []
+    while True:
+        page = muxer.flush() if flush else muxer.pageout()
+        ret.append(page)
+        if page is None:
+            return ret
+
+
+def run_stream(rng: random.Random, serialno: int, ogg_class: Type) -> int:
+    """Mux one random stream with both; returns the number of pages."""
+    muxers = [OggMuxer(serialno), ogg_class(serialno)]
+    n_pages = 0
+    granulepos = 0
+    n_batches = rng.randrange(1, 30)
+    for batch in range(n_batches):
+        n_packets = rng.randrange(1, 8)
+        for i in range(n_packets):
+            packet = os.urandom(max(0, random_packet_size(rng)))
+            granulepos += rng.choice((120, 480, 960, 2880))
+            b_o_s = batch == 0 and i == 0
+            e_o_s = batch == n_batches - 1 and i == n_packets - 1 and \
+                rng.random() < 0.5
+            for m in muxers:
+                m.packetin(packet, granulepos, b_o_s=b_o_s, e_o_s=e_o_s)
+        flush = rng.random() < 0.5
+        expected = _drain(muxers[1], flush)
+        actual = _drain(muxers[0], flush)
+        if expected != actual:
+            print('mismatch in batch {} ({}): libogg={} OggMuxer={}'.format(
+                batch, 'flush' if flush else 'pageout',
+                [p and len(p) for p in expected],
+                [p and len(p) for p in actual]))
+            sys.exit(1)
+        n_pages += len(expected) - 1
+    # the rest of the stream
+    expected, actual = _drain(muxers[1], True), _drain(muxers[0], True)
+    if expected != actual:
+        print('mismatch in the final flush')
+        sys.exit(1)
+    return n_pages + len(expected) - 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    try:
+        from asr_proxy_server.libogg import Ogg
+    except OSError as e:
+        sys.exit('libogg is required: {}'.format(e))
+
+    rng = random.Random(args.seed)
+    n_pages = 0
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        n_pages += run_stream(rng, rng.randrange(-2**31, 2**31), Ogg)
+    print('{} streams ({} pages) agree in {:.1f}s'.format(
+        args.iterations, n_pages, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
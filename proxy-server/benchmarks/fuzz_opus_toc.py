@@ -0,0 +1,86 @@
+"""Fuzz `opus_packet_samples` against libopus.
+
+Random packets (fully random and structurally plausible ones) are
+checked against `opus_packet_parse` / `opus_packet_get_nb_samples`: both
+must agree on whether a packet is malformed and, if not, on its number of
+samples. libopus is looked up like by the server (`ASR_LIBOPUS_PATH`
+sets its path).
+
+Usage: python benchmarks/fuzz_opus_toc.py --iterations 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from asr_proxy_server.opus import (  # noqa: E402
+    InvalidOpusPacket, opus_packet_samples)
+
+
+def _frame_length(n: int) -> bytes:
+    if n < 252:
+        return bytes([n])
+    return bytes([252 + (n - 252) % 4, (n - 252) // 4])
+
+
+def random_packet(rng: random.Random) -> bytes:
+    kind = rng.randrange(4)
+    if kind == 0:  # anything
+        return os.urandom(rng.choice((0, 1, 2, 3, 4, 8, 64, 1300, 2600)))
+    toc = rng.randrange(256)
+    if kind == 1 or toc & 3 != 3:  # short random payload
+        return bytes([toc]) + os.urandom(rng.randrange(0, 1400))
+    # code 3 with mostly consistent padding / frame lengths
+    count = rng.randrange(0, 50)
+    vbr, pad = rng.random() < 0.5, rng.random() < 0.3
+    frames = [rng.randrange(0, 1276 if rng.random() < 0.1 else 200)
+              for _ in range(max(1, count))]
+    if not vbr:
+        frames = [frames[0]] * len(frames)
+    ret = bytearray([toc | 3, count | (vbr << 7) | (pad << 6)])
+    padding = rng.randrange(0, 600) if pad else 0
+    if pad:
+        ret += b'\xff' * (padding // 254) + bytes([padding % 254])
+    if vbr:
+        for n in frames[:-1]:
+            ret += _frame_length(n)
+    ret += os.urandom(max(0, sum(frames) + rng.choice((0, 0, 0, 1, -1))))
+    ret += bytes(padding)
+    return bytes(ret)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        from asr_proxy_server.libopus import packet_get_nb_samples
+    except OSError as e:
+        sys.exit('libopus is required: {}'.format(e))
+
+    rng = random.Random(args.seed)
+    n_valid = 0
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        packet = random_packet(rng)
+        expected = packet_get_nb_samples(packet)
+        try:
+            actual = opus_packet_samples(packet)
+        except InvalidOpusPacket:
+            actual = -1
+        if (expected < 0) != (actual < 0) or \
+                (expected >= 0 and expected != actual):
+            print('mismatch: libopus={} opus.py={} packet={}'.format(
+                expected, actual, packet[:16].hex()))
+            sys.exit(1)
+        n_valid += expected >= 0
+    print('{} packets ({} valid) agree in {:.1f}s'.format(
+        args.iterations, n_valid, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Load generator for the /ws endpoint.
+
+Starts the FastAPI `app` with uvicorn in a child process (or targets
+`--url`) and runs `--sessions` recognition sessions, `--concurrency` at a
+time. Each session sends the init message and the opus packets of
+`--input` (an Ogg Opus file; synthetic 20ms packets by default) at
+`--speed` times real-time (0: as fast as possible).
+
+Usage: python benchmarks/loadtest.py --sessions 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import websockets  # type: ignore
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from asr_proxy_server.opus import (  # noqa: E402
+    iter_ogg_packets, opus_packet_samples)
+
+INIT_MSG = {
+    'pre_skip': 312,
+    'version': 'libopus 1.3.1',
+    'engine': 'dummy',
+    'engine-config': {'interim_results': True},
+}
+
+
+def load_packets(path: Optional[str], seconds: float) -> List[bytes]:
+    if path is None:
+        # 20ms CELT-only fullband frames (config 31, code 0)
+        return [bytes([31 << 3]) + os.urandom(79)
+                for _ in range(int(seconds * 50))]
+    with open(path, 'rb') as f:
+        packets = list(iter_ogg_packets(f.read()))
+    return packets[2:]  # skip OpusHead and OpusTags
+
+
+class Stats(object):
+    def __init__(self) -> None:
+        self.first_result: List[float] = []
+        self.final: List[float] = []
+        self.errors = 0
+
+
+async def run_session(url: str, init_msg: Dict[str, Any],
+                      packets: List[bytes], speed: float,
+                      stats: Stats) -> None:
+    try:
+        async with websockets.connect(url) as ws:
+            await ws.send(json.dumps(init_msg))
+            start = time.perf_counter()
+            first_result: Optional[float] = None
+            end_of_audio: Optional[float] = None
+            final: Optional[float] = None  # first final after end of audio
+
+            async def _send() -> None:
+                nonlocal end_of_audio
+                t = 0.0
+                for packet in packets:
+                    await ws.send(packet)
+                    if speed > 0:
+                        t += opus_packet_samples(packet) / 48000
+                        delay = start + t / speed - time.perf_counter()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                await ws.send(b'')
+                end_of_audio = time.perf_counter()
+
+            sender = asyncio.create_task(_send())
+            async for msg in ws:
+                resp = json.loads(msg)
+                if isinstance(resp, list):
+                    now = time.perf_counter()
+                    if first_result is None:
+                        first_result = now - start
+                    if final is None and end_of_audio is not None and \
+                            any(r.get('is_final') for r in resp):
+                        final = now - end_of_audio
+                    continue
+                if resp.get('type') == 'error':
+                    stats.errors += 1
+                break
+            await sender
+            if first_result is not None:
+                stats.first_result.append(first_result)
+            if final is not None:
+                stats.final.append(final)
+    except Exception:
+        stats.errors += 1
+
+
+def proc_usage(pid: int) -> Tuple[float, int]:
+    """Return (cpu seconds, rss bytes) of process `pid` (Linux only)."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+
+def start_server(port: int) -> subprocess.Popen:
+    cwd = os.path.join(os.path.dirname(__file__), '..')
+    cmd = [sys.executable, '-m', 'uvicorn', 'asr_proxy_server:app',
+           '--host', '127.0.0.1', '--port', str(port),
+           '--log-level', 'warning']
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run(url: str, n_sessions: int, concurrency: int,
+              init_msg: Dict[str, Any], packets: List[bytes],
+              speed: float) -> Tuple[Stats, float]:
+    stats = Stats()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _one() -> None:
+        async with sem:
+            await run_session(url, init_msg, packets, speed, stats)
+    start = time.perf_counter()
+    await asyncio.gather(*[_one() for _ in range(n_sessions)])
+    return stats, time.perf_counter() - start
+
+
+def _percentiles(values: List[float]) -> str:
+    if not values:
+        return 'n/a'
+    values = sorted(values)
+    return 'p50={:.1f}ms p99={:.1f}ms'.format(
+        statistics.median(values) * 1000,
+        values[min(len(values) - 1, int(len(values) * 0.99))] * 1000)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', help='target server (default: spawn one)')
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--input', help='Ogg Opus file to send')
+    parser.add_argument('--seconds', type=float, default=3.0,
+                        help='length of the synthetic audio')
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--init', help='JSON file of the init message')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='fake result latency of the dummy engine [s]')
+    args = parser.parse_args()
+
+    init_msg = dict(INIT_MSG)
+    if args.init:
+        with open(args.init) as f:
+            init_msg = json.load(f)
+    init_msg.setdefault('engine-config', {}).setdefault('delay', args.delay)
+    packets = load_packets(args.input, args.seconds)
+
+    proc = None
+    url = args.url
+    if url is None:
+        port = _free_port()
+        proc = start_server(port)
+        url = 'ws://127.0.0.1:{}/ws'.format(port)
+    try:
+        if proc:
+            cpu0, rss0 = proc_usage(proc.pid)
+        stats, elapsed = asyncio.run(run(
+            url, args.sessions, args.concurrency, init_msg, packets,
+            args.speed))
+        n_ok = args.sessions - stats.errors
+        print('sessions: {} ok, {} errors in {:.2f}s ({:.1f} sessions/sec)'
+              .format(n_ok, stats.errors, elapsed, n_ok / elapsed))
+        print('time to first result:', _percentiles(stats.first_result))
+        print('time to final:       ', _percentiles(stats.final))
+        if proc:
+            cpu1, rss1 = proc_usage(proc.pid)
+            print('server cpu: {:.2f}ms/session, rss growth: {:.1f}MiB'
+                  .format((cpu1 - cpu0) / max(1, n_ok) * 1000,
+                          (rss1 - rss0) / 2**20))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
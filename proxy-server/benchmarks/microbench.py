@@ -0,0 +1,191 @@
+"""Microbenchmarks for the proxy hot path.
+
+Usage: python benchmarks/microbench.py [--seconds N] [name ...]
+"""
+import argparse
+import array
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+BENCHMARKS: Dict[str, Callable[[float], float]] = {}
+
+# 20ms CELT-only fullband frame (config 31, code 0) at ~32kbps
+OPUS_20MS_PACKET = bytes([31 << 3]) + os.urandom(79)
+
+
+def benchmark(name: str) -> Callable[[Callable[[float], float]],
+                                     Callable[[float], float]]:
+    def _register(fn: Callable[[float], float]) -> Callable[[float], float]:
+        BENCHMARKS[name] = fn
+        return fn
+    return _register
+
+
+def measure(fn: Callable[[], None], seconds: float) -> float:
+    """Call `fn` repeatedly for about `seconds` and return calls/sec."""
+    n, batch = 0, 64
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            fn()
+        n += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return n / elapsed
+
+
+def _legacy_ogg_class() -> type:
+    """libogg.Ogg as it was before the zero-copy packetin/page-out path."""
+    from ctypes import cast
+
+    from asr_proxy_server.libogg import Ogg, c_uint8_p, libogg
+
+    class LegacyOgg(Ogg):
+        def __init__(self, serialno: int) -> None:
+            super().__init__(serialno)
+            self._packet_buf = array.array('B', [0] * (2**14))
+            self._packet_ptr = cast(
+                self._packet_buf.buffer_info()[0], c_uint8_p)
+
+        def packetin(self, packet: bytes, granulepos: int,  # type: ignore
+                     *, b_o_s: bool = False, e_o_s: bool = False) -> None:
+            for i, b in enumerate(packet):
+                self._packet_buf[i] = b
+            self._packet.packet = self._packet_ptr
+            self._packet.bytes = len(packet)
+            self._packet.b_o_s = 1 if b_o_s else 0
+            self._packet.e_o_s = 1 if e_o_s else 0
+            self._packet.granulepos = granulepos
+            self._packet.packetno = self._packetno
+            self._packetno += 1
+            if libogg.ogg_stream_packetin(self._state, self._packet) != 0:
+                raise RuntimeError('ogg_stream_packetin failed')
+
+        def _copy_page(self) -> bytes:
+            total_len = self._page.header_len + self._page.body_len
+            for i in range(self._page.header_len):
+                self._cache[i] = self._page.header[i]
+            for i in range(self._page.body_len):
+                self._cache[self._page.header_len + i] = self._page.body[i]
+            return memoryview(self._cache)[0:total_len].tobytes()
+
+    return LegacyOgg
+
+
+def _ogg_packetin_flush(ogg_class: type, seconds: float) -> float:
+    ogg = ogg_class(1)
+    granulepos = 0
+
+    def _step() -> None:
+        nonlocal granulepos
+        granulepos += 960
+        ogg.packetin(OPUS_20MS_PACKET, granulepos)
+        ogg.flush()
+    return measure(_step, seconds)
+
+
+@benchmark('libogg-legacy')
+def bench_libogg_legacy(seconds: float) -> float:
+    return _ogg_packetin_flush(_legacy_ogg_class(), seconds)
+
+
+@benchmark('libogg')
+def bench_libogg(seconds: float) -> float:
+    from asr_proxy_server.libogg import Ogg
+    return _ogg_packetin_flush(Ogg, seconds)
+
+
+@benchmark('ogg-muxer')
+def bench_ogg_muxer(seconds: float) -> float:
+    from asr_proxy_server.opus import OggMuxer
+    return _ogg_packetin_flush(OggMuxer, seconds)
+
+
+@benchmark('toc')
+def bench_toc(seconds: float) -> float:
+    from asr_proxy_server.opus import opus_packet_samples
+    return measure(lambda: opus_packet_samples(OPUS_20MS_PACKET), seconds)
+
+
+def _ingest_20ms(encoding: str, fs: int, channels: int,
+                 seconds: float) -> float:
+    """One 20ms message of raw audio to 16kHz mono (ops = messages)."""
+    from asr_proxy_server.ingest import AudioFormat, PcmIngest
+    fmt = AudioFormat(encoding, fs, channels)
+    ingest = PcmIngest(fmt, 16000)
+    n = fs // 50 * channels * (1 if encoding == 'mulaw' else 2)
+    data = os.urandom(n)
+    return measure(lambda: ingest.process(data), seconds)
+
+
+@benchmark('ingest-mulaw-8k')
+def bench_ingest_mulaw(seconds: float) -> float:
+    return _ingest_20ms('mulaw', 8000, 1, seconds)
+
+
+@benchmark('ingest-stereo-44k')
+def bench_ingest_stereo(seconds: float) -> float:
+    return _ingest_20ms('linear16', 44100, 2, seconds)
+
+
+def _interim_results() -> list:
+    from asr_proxy_server.engine_base import SpeechRecognitionAlternative
+    from asr_proxy_server.google_speech_to_text import SpeechRecognitionResult
+    return [SpeechRecognitionResult(
+        alternatives=[SpeechRecognitionAlternative(
+            transcript='今日はいい天気ですね 明日も晴れるでしょうか', confidence=0.0)],
+        is_final=False, stability=0.9)]
+
+
+def _legacy_to_dict(result: Any) -> Dict[str, Any]:
+    """SpeechRecognitionResult.to_dict as it was before `to_json`."""
+    from dataclasses import asdict
+
+    def remove_none(o: Dict[str, Any]) -> Dict[str, Any]:
+        for k in [k for k, v in o.items() if v is None]:
+            o.pop(k)
+        return o
+    obj = remove_none(asdict(result))
+    for alt in obj['alternatives']:
+        remove_none(alt)
+    return obj
+
+
+@benchmark('serialize-legacy')
+def bench_serialize_legacy(seconds: float) -> float:
+    """`to_dict` (dataclasses.asdict) + json.dumps, as before __slots__."""
+    import json
+    results = _interim_results()
+    return measure(lambda: json.dumps(
+        [_legacy_to_dict(r) for r in results], ensure_ascii=False,
+        separators=(',', ':'), allow_nan=False), seconds)
+
+
+@benchmark('serialize')
+def bench_serialize(seconds: float) -> float:
+    from asr_proxy_server.messages import encode_results
+    results = _interim_results()
+    return measure(lambda: encode_results(results), seconds)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=1.0)
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='one of: ' + ', '.join(BENCHMARKS))
+    args = parser.parse_args(argv)
+    for name in args.names or list(BENCHMARKS):
+        try:
+            rate = BENCHMARKS[name](args.seconds)
+        except (AttributeError, OSError) as e:  # missing native library
+            print('{:<24} skipped ({})'.format(name, e))
+            continue
+        print('{:<24} {:>12,.0f} ops/sec'.format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
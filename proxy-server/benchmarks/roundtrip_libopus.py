@@ -0,0 +1,122 @@
+"""Round-trip checks of the numpy paths of `libopus`.
+
+Random audio is encoded by `OpusEncoder.encode_many` / `encode` and
+decoded again by `OpusDecoder.decode` (int16 and float32, into the
+decoder's buffer and into `out`), `decode_many` and `decode_gap` for each
+opus sample rate, channel count and frame size; the number of samples,
+shape and dtype of every result must match the frames that were encoded,
+and a decoded tone must correlate with the input.
+
+Usage: python benchmarks/roundtrip_libopus.py
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from asr_proxy_server.ingest import OPUS_SAMPLE_RATES  # noqa: E402
+
+FRAME_MS = (2.5, 5, 10, 20, 40, 60)
+
+
+def _check(cond: bool, what: str) -> None:
+    if not cond:
+        print('failed: ' + what)
+        sys.exit(1)
+
+
+def roundtrip(rng: np.random.Generator, fs: int, ch: int,
+              frame_ms: float) -> int:
+    """Check one configuration; returns the number of packets."""
+    from asr_proxy_server.libopus import (
+        OpusDecoder, OpusEncoder, packet_get_nb_samples)
+
+    what = '{}Hz {}ch {}ms'.format(fs, ch, frame_ms)
+    frame_size = int(fs * frame_ms / 1000)
+    n_frames = int(rng.integers(1, 20))
+    pcm = rng.integers(-8000, 8000, (n_frames * frame_size + 7) * ch,
+                       dtype=np.int16)
+
+    encoder = OpusEncoder(fs, ch)
+    packets = encoder.encode_many(pcm, frame_size)
+    _check(len(packets) == n_frames, what + ': encode_many frames')
+    single = OpusEncoder(fs, ch).encode(pcm[:frame_size * ch].tobytes())
+    _check(single == packets[0], what + ': encode != encode_many')
+    for packet in packets:
+        _check(packet_get_nb_samples(packet, fs) == frame_size,
+               what + ': packet_get_nb_samples')
+        _check(packet_get_nb_samples(memoryview(packet), fs) == frame_size,
+               what + ': packet_get_nb_samples(memoryview)')
+
+    decoder = OpusDecoder(fs, ch)
+    out = np.zeros(frame_size * ch * 2, np.float32)
+    for packet in packets:
+        x = decoder.decode(packet)
+        _check(x.shape == (frame_size * ch,) and x.dtype == np.int16,
+               what + ': decode shape')
+        y = decoder.decode(packet, dtype=np.float32)
+        _check(y.shape == (frame_size * ch,) and y.dtype == np.float32,
+               what + ': decode float32 shape')
+        z = decoder.decode(packet, out=out)
+        _check(z.shape == (frame_size * ch,) and
+               np.shares_memory(z, out), what + ': decode into out')
+
+    x = OpusDecoder(fs, ch).decode_many(packets)
+    _check(x.shape == (n_frames * frame_size * ch,) and
+           x.dtype == np.int16, what + ': decode_many shape')
+    x = OpusDecoder(fs, ch).decode_many(
+        [memoryview(p) for p in packets], dtype=np.float32)
+    _check(x.shape == (n_frames * frame_size * ch,) and
+           x.dtype == np.float32, what + ': decode_many float32 shape')
+
+    # gaps are filled in multiples of 2.5ms (also beyond 120ms)
+    gap = int(rng.integers(0, fs // 2))
+    expected = gap - gap % (fs // 400)
+    for next_packet in (None, packets[-1]):
+        decoder = OpusDecoder(fs, ch)
+        decoder.decode(packets[0])
+        x = decoder.decode_gap(gap, next_packet)
+        _check(x.shape == (expected * ch,), what + ': decode_gap shape')
+    return len(packets)
+
+
+def tone_correlation(fs: int) -> float:
+    """Correlation of a decoded 440Hz tone with the input (mono, 20ms)."""
+    from asr_proxy_server.libopus import OpusDecoder, OpusEncoder
+    encoder = OpusEncoder(fs, 1)
+    t = np.arange(fs) / fs
+    pcm = (8000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    decoded = OpusDecoder(fs, 1).decode_many(
+        encoder.encode_many(pcm, fs // 50))
+    delay = encoder.lookahead
+    a = pcm[fs // 10:len(decoded) - delay].astype(np.float64)
+    b = decoded[fs // 10 + delay:].astype(np.float64)
+    return float(np.corrcoef(a, b)[0, 1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n_packets = 0
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        for fs in OPUS_SAMPLE_RATES:
+            for ch in (1, 2):
+                for frame_ms in FRAME_MS:
+                    n_packets += roundtrip(rng, fs, ch, frame_ms)
+    for fs in OPUS_SAMPLE_RATES:
+        r = tone_correlation(fs)
+        _check(r > 0.9, '{}Hz tone correlation {:.3f}'.format(fs, r))
+    print('{} packets round-tripped in {:.1f}s'.format(
+        n_packets, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()